@@ -21,6 +21,7 @@
 
 import argparse
 import contextlib
+import json
 import os
 import nr.fs
 import requests
@@ -31,6 +32,7 @@ import textwrap
 import time
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
 from . import __version__, client, config
 from .client import log
 from .core import remotepy
@@ -75,6 +77,10 @@ def get_argument_parser(prog):
     '"user@host".')
   parser.add_argument('-v', '--verbose', action='count', default=0,
     help='Generate more output, such as sub-commands that are being invoked.')
+  parser.add_argument('--hosts', metavar='SELECTOR', help='Run the ls, info '
+    'or compose command on many hosts in parallel. SELECTOR is a comma-'
+    'separated list of names or glob patterns for the `remotes` inventory '
+    'in the configuration, or "all".')
 
   tunnel = subparsers.add_parser('tunnel', help='Create a tunnel to a docker daemon.')
   shell = subparsers.add_parser('shell', help='Create a tunnel and enter a new '
@@ -82,6 +88,7 @@ def get_argument_parser(prog):
     'through docker-remote, allowing you to use your normal docker-compose '
     'workflow while having the benefits of docker-remote.')
   ls = subparsers.add_parser('ls', help='List projects on the host.')
+  ls.add_argument('--json', action='store_true', help='Print JSON.')
 
   rm = subparsers.add_parser('rm', help='Delete a project on the host.')
   rm.add_argument('-y', '--yes', action='store_true',
@@ -91,9 +98,34 @@ def get_argument_parser(prog):
   scp = subparsers.add_parser('scp', help='Download a volume or multiple volume '
     'directories from the host. If no volumes are specified, the whole '
     'project directory is downloaded.')
+  scp.add_argument('--sync', action='store_true', help='Only download '
+    'files that are new or changed compared to the target directory. An '
+    'interrupted download continues where it stopped when run again.')
+  scp.add_argument('--delete', action='store_true', help='With --sync, '
+    'delete files in the target directory that do not exist on the host.')
+  scp.add_argument('-j', '--jobs', type=int, help='The number of volumes '
+    'to download at the same time. Defaults to the `[scp] jobs` option or 4.')
+  scp.add_argument('--compress', choices=sorted(client.sync.COMPRESSORS),
+    help='The compression of the transfer. zstd falls back to gzip if it is '
+    'not available. Defaults to the `[scp] compress` option or gzip.')
+  scp.add_argument('--compress-level', type=int, help='The compression level.')
   scp.add_argument('directory', help='The target directory.')
   scp.add_argument('volumes', nargs='*', help='Volume names to download.')
 
+  push = subparsers.add_parser('push', help='Upload the local sources of the '
+    'relative volumes in the docker-compose.yml (like ./data:/data) to the '
+    'project directory on the host. Only new and changed files are sent.')
+  push.add_argument('--delete', action='store_true', help='Delete files '
+    'on the host that do not exist locally.')
+  push.add_argument('-j', '--jobs', type=int, help='The number of volumes '
+    'to upload at the same time. Defaults to the `[scp] jobs` option or 4.')
+  push.add_argument('--compress', choices=sorted(client.sync.COMPRESSORS),
+    help='The compression of the transfer. Defaults to the `[scp] compress` '
+    'option or gzip.')
+  push.add_argument('--compress-level', type=int, help='The compression level.')
+  push.add_argument('volumes', nargs='*', help='The volumes to upload, like '
+    '"data" for ./data. Defaults to all relative volumes.')
+
   ssh = subparsers.add_parser('ssh')
   ssh.add_argument('argv', nargs='...')
 
@@ -103,6 +135,18 @@ def get_argument_parser(prog):
   compose = subparsers.add_parser('compose', help='Wrapper for docker-compose.')
   compose.add_argument('-p', '--project-name')
   compose.add_argument('--rm', action='store_true', help='Remove the project after running.')
+  compose.add_argument('--on-host', action='store_const', const=True,
+    help='Run docker-compose on the host instead of through the tunnel. '
+    'The output is streamed back. Can also be enabled with the '
+    '`[compose] on_host` option.')
+  compose.add_argument('--force-deploy', action='store_true',
+    help='Run "up" even if the configuration did not change since the '
+    'last successful deployment.')
+  compose.add_argument('--all', metavar='PATH', help='Run docker-compose for '
+    'all projects in the directory tree PATH, or for the projects listed in '
+    'the manifest file PATH. The projects of a host share one connection.')
+  compose.add_argument('-j', '--jobs', type=int, default=4, help='The number '
+    'of projects to run at the same time with --all. Defaults to 4.')
   compose.add_argument('argv', nargs='...')
 
   install = subparsers.add_parser('install', help='Install docker-remote on a host. '
@@ -117,12 +161,89 @@ def get_argument_parser(prog):
 
   info = subparsers.add_parser('info', help='Show configuration in the current context.')
   info.add_argument('--host-version', action='store_true')
+  info.add_argument('--json', action='store_true', help='Print JSON (with --hosts).')
 
   render = subparsers.add_parser('render', help='Render the current docker-compose.yml')
 
   return parser
 
 
+def select_remotes(parser, args):
+  try:
+    return client.select_remotes(args.hosts)
+  except ValueError as exc:
+    parser.error(str(exc))
+
+
+def run_on_hosts(parser, args, func, header):
+  """
+  Runs *func* with a #client.Client for every host selected with `--hosts`
+  and prints the rows returned by *func* as a table (prefixed with the
+  remote name) or JSON. Returns 1 if any host failed.
+  """
+
+  remotes = select_remotes(parser, args)
+  hosts = {name: client.multi.get_host_string(host, user) for name, host, user in remotes}
+  results = client.multi.run_on_hosts(remotes, func)
+  if args.json:
+    data = []
+    for name, rows, exc in results:
+      item = {'remote': name, 'host': hosts[name]}
+      if exc is not None:
+        item['error'] = str(exc)
+      else:
+        item['results'] = [dict(zip(header, row)) for row in rows]
+      data.append(item)
+    print(json.dumps(data, indent=2))
+  else:
+    table = []
+    for name, rows, exc in results:
+      if exc is not None:
+        table.append([name, hosts[name], 'error: {}'.format(exc)] + [''] * (len(header) - 1))
+      table += [[name, hosts[name]] + list(row) for row in rows or ()]
+    print(client.multi.format_table(['remote', 'host'] + list(header), table))
+  failed = [name for name, _, exc in results if exc is not None]
+  if failed:
+    log.error('{} of {} hosts failed: {}'.format(len(failed), len(results), ', '.join(failed)))
+    return 1
+  return 0
+
+
+def compose_all(parser, args):
+  hosts = [args.host]
+  if args.hosts:
+    hosts = [client.multi.get_host_string(host, user)
+             for _, host, user in select_remotes(parser, args)]
+  if args.all and args.project_name:
+    parser.error('--project-name can not be combined with --all')
+  try:
+    directories = client.multi.find_project_dirs(args.all) if args.all else ['.']
+    placers = {}
+    projects = [client.multi.load_project(x, host, placers, args.project_name)
+                for x in directories for host in hosts]
+  except (OSError, RuntimeError, ValueError) as exc:
+    parser.error(str(exc))
+  if not projects:
+    parser.error('no projects found in {!r}'.format(args.all))
+
+  argv = ['-v'] * args.verbose + ['compose']
+  if args.project_name:
+    argv += ['-p', args.project_name]
+  if args.on_host:
+    argv.append('--on-host')
+  if args.force_deploy:
+    argv.append('--force-deploy')
+  runner = client.multi.ProjectRunner(projects, args.jobs, with_host=len(hosts) > 1)
+  results = runner.run(argv + args.argv)
+
+  failed = [runner.label(project) for project, code in results if code != 0]
+  if failed:
+    log.error('{} of {} projects failed: {}'.format(
+      len(failed), len(results), ', '.join(failed)))
+    return 1
+  return 0
+
+
 def main(argv=None, prog=None):
   parser = get_argument_parser(prog)
   args = parser.parse_args(argv)
@@ -133,11 +254,17 @@ def main(argv=None, prog=None):
   elif args.verbose > 0:
     log.logger.setLevel(log.logging.DEBUG)
 
+  if args.hosts and args.command not in ('compose', 'ls', 'info'):
+    parser.error('--hosts is not supported for the {} command'.format(args.command))
+  if args.command == 'compose' and (args.all or args.hosts):
+    return compose_all(parser, args)
+
   # Read the local configuration file.
   docker_compose_file = 'docker-compose.yml'
+  docker_compose_hash = None
   if os.path.isfile(docker_compose_file):
-    with open(docker_compose_file, 'r') as fp:
-      docker_compose_data = yaml.safe_load(fp)
+    docker_compose_data, docker_compose_hash = \
+      client.rendercache.load_compose_file(docker_compose_file)
     if 'x-docker-remote' in docker_compose_data:
       config.merge(config.data, docker_compose_data['x-docker-remote'])
       # Extension fields are supported by the file format specification,
@@ -146,6 +273,7 @@ def main(argv=None, prog=None):
   else:
     docker_compose_data = None
 
+  explicit_host = args.host
   if not args.host:
     args.host = client.get_remote_string()
   if not args.project_name:
@@ -154,12 +282,34 @@ def main(argv=None, prog=None):
   else:
     config.set('project.name', args.project_name)
 
+  placement_hosts = config.get('placement.hosts', None)
+  if not explicit_host and placement_hosts and args.project_name:
+    placed = client.placement.get_placement(args.project_name)
+    if not placed and args.command == 'compose':
+      try:
+        placed = client.placement.place_project(args.project_name, placement_hosts)
+      except (RuntimeError, ValueError) as exc:
+        parser.error(str(exc))
+    if placed:
+      args.host = placed
+
   if args.host:
     client.set_remote_config(args.host)
 
+  if args.command in ('ls', 'info') and args.hosts:
+    if args.command == 'ls':
+      func = lambda cl: [[x] for x in cl.list_projects()]
+      return run_on_hosts(parser, args, func, ['project'])
+    func = lambda cl: [[cl.get_host_version()]]
+    return run_on_hosts(parser, args, func, ['version'])
+
   if args.command == 'ls':
-    with client.Client() as cl:
-      for project in cl.list_projects():
+    with client.Client(create_tunnel=False) as cl:
+      projects = cl.list_projects()
+    if args.json:
+      print(json.dumps(projects, indent=2))
+    else:
+      for project in projects:
         print(project)
     return 0
 
@@ -192,6 +342,7 @@ def main(argv=None, prog=None):
   elif args.command == 'docker':
     with client.Client() as cl:
       command = ['docker'] + args.argv
+      cl.wait_tunnel()
       log.info('$ ' + shell_convert(command))
       return shell_call(command)
 
@@ -200,12 +351,15 @@ def main(argv=None, prog=None):
       parser.error('file {!r} does not exist'.format(docker_compose_file))
     if not args.project_name:
       parser.error(MISSING_PROJECT_NAME)
-    with client.Client() as cl:
+    create_tunnel = None
+    if args.command == 'render' or client.compose_runs_on_host(args.argv, args.on_host):
+      create_tunnel = False
+    with client.Client(create_tunnel=create_tunnel) as cl:
       if args.command == 'compose':
-          return cl.compose(args.argv, docker_compose_data)
+          return cl.compose(args.argv, docker_compose_data, on_host=args.on_host,
+            file_hash=docker_compose_hash, force_deploy=args.force_deploy)
       elif args.command == 'render':
-        cl.process_docker_compose(docker_compose_data)
-        print(yaml.dump(docker_compose_data))
+        print(cl.render(docker_compose_data, docker_compose_hash)['yaml'])
       else:
         assert False, args.command
     return 0
@@ -215,7 +369,13 @@ def main(argv=None, prog=None):
       parser.error('It seems you are already inside a docker-remote shell.')
     is_shell = args.command == 'shell'
 
+    if is_shell and config.get('agent.shell', True) and client.agent.is_supported():
+      # Commands in the shell reuse the tunnel and session of the agent.
+      host, user = client.get_remote_config()
+      os.environ[client.agent.AGENT_VAR] = client.agent.start_agent(host, user)
+
     with client.Client() as cl, contextlib.ExitStack() as stack:
+      cl.wait_tunnel()
       if is_shell:
         shell = os.getenv('SHELL', '')
         if not shell:
@@ -235,7 +395,7 @@ def main(argv=None, prog=None):
       elif cl.tunnel:
         print('DOCKER_HOST={}'.format(cl.tunnel.docker_host))
         while cl.tunnel.status() == 'alive':
-          time.sleep(0.1)
+          time.sleep(1)
         if cl.tunnel.status() != 'ended':
           return 1
 
@@ -247,6 +407,8 @@ def main(argv=None, prog=None):
   elif args.command == 'scp':
     if not args.project_name:
       parser.error(MISSING_PROJECT_NAME)
+    if args.delete and not args.sync:
+      parser.error('--delete requires --sync')
 
     host, user = client.get_remote_config()
     if host == 'localhost' and not user:
@@ -263,29 +425,67 @@ def main(argv=None, prog=None):
           (cl.get_volume_path(args.project_name, args.volumes[0]), args.directory)
         ]
       elif args.volumes:
+        paths = cl.get_volume_paths(args.project_name, args.volumes)
         downloads = [
-          (cl.get_volume_path(args.project_name, vol), os.path.join(args.directory, vol))
-          for vol in args.volumes
+          (path, os.path.join(args.directory, vol))
+          for path, vol in zip(paths, args.volumes)
         ]
       else:
         downloads = [(cl.get_project_path(args.project_name), args.directory)]
 
-      code = 0
-      for source_dir, dest_dir in downloads:
+      level = args.compress_level
+      if level is None:
+        level = config.get('scp.compress_level', None)
+      try:
+        compression = client.sync.get_compression(cl,
+          args.compress or config.get('scp.compress', 'gzip'), level)
+      except ValueError as exc:
+        parser.error(str(exc))
+      if args.sync:
+        manifests = cl.get_manifests([src for src, _ in downloads])
+
+    # The volumes are transferred concurrently, one stream each.
+    jobs = args.jobs or config.get('scp.jobs', 4)
+    verbose = len(downloads) == 1 or jobs == 1
+    def transfer(index):
+      source_dir, dest_dir = downloads[index]
+      if args.sync:
+        return client.sync.sync_directory(source_dir, dest_dir, manifests[index],
+          args.delete, compression, level)
+      if host == 'localhost' and not user:
         nr.fs.makedirs(dest_dir)
-        if host == 'localhost' and not user:
-          command = ['cp', '-rv', source_dir, dest_dir]
-          cmd = shell_convert(command)
-        else:
-          command1 = ['ssh', '{}@{}'.format(user, host), 'tar', '-czC', source_dir, '-f', '-', '.']
-          command2 = ['tar', '-vxzC', dest_dir]
-          cmd = shell_convert(command1) + ' | ' + shell_convert(command2)
-        log.info('$ ' + cmd)
-        code = shell_call(cmd)
-        if code != 0:
-          break
+        command = ['cp', '-rv', source_dir, dest_dir]
+        log.info('$ ' + shell_convert(command))
+        return shell_call(command)
+      return client.sync.download(source_dir, dest_dir, None, compression,
+        level, verbose)
 
-      return code
+    with ThreadPoolExecutor(max(1, jobs)) as executor:
+      codes = list(executor.map(transfer, range(len(downloads))))
+    return next((x for x in codes if x != 0), 0)
+
+  elif args.command == 'push':
+    if docker_compose_data is None:
+      parser.error('file {!r} does not exist'.format(docker_compose_file))
+    if not args.project_name:
+      parser.error(MISSING_PROJECT_NAME)
+    volumes = client.sync.get_relative_volumes(docker_compose_data)
+    if args.volumes:
+      unknown = [x for x in args.volumes if os.path.normpath(x) not in volumes]
+      if unknown:
+        parser.error('not a relative volume: {}'.format(', '.join(unknown)))
+      volumes = [os.path.normpath(x) for x in args.volumes]
+    level = args.compress_level
+    if level is None:
+      level = config.get('scp.compress_level', None)
+    with client.Client(create_tunnel=False) as cl:
+      try:
+        return client.sync.push_volumes(cl, args.project_name, volumes, args.delete,
+          args.compress or config.get('scp.compress', 'gzip'), level,
+          args.jobs or config.get('scp.jobs', 4),
+          config.get('scp.blob_threshold', 1024 * 1024))
+      except ValueError as exc:
+        parser.error(str(exc))
 
   elif args.command == 'ssh':
     with client.Client(create_tunnel=False) as cl:
@@ -294,7 +494,7 @@ def main(argv=None, prog=None):
       path = cl.get_project_path(args.project_name)
     if not args.argv:
       args.argv = ['-t', 'cd "{}"; bash -l'.format(path)]
-    return subprocess.check_call(['ssh', client.get_remote_string()] + args.argv)
+    return subprocess.check_call(client.get_ssh_command(*args.argv))
 
   elif args.command == 'install':
     host, user = client.get_remote_config()
@@ -320,7 +520,7 @@ def main(argv=None, prog=None):
         host_archive_filename = host_archive_filename.format(version=description)
 
         print('Sending to host: "{}" ...'.format(host_archive_filename))
-        client.send_file(fp.name, host_archive_filename)
+        client.send_blob(fp.name, host_archive_filename)
 
     # Otherwise, we'll download the matching version from GitHub.
     else:
@@ -334,7 +534,7 @@ def main(argv=None, prog=None):
         host_archive_filename = host_archive_filename.format(version=__version__)
 
         print('Sending to host: "{}" ...'.format(host_archive_filename))
-        client.send_file(fp.name, host_archive_filename)
+        client.send_blob(fp.name, host_archive_filename)
 
     # Ensure that ~/.local/bin is in the PATH.
     commands.append(textwrap.dedent('''
@@ -348,15 +548,25 @@ def main(argv=None, prog=None):
     # Install the package with Pip.
     commands.append('{pip} install --upgrade --user "' + host_archive_filename + '"')
 
+    # Daemons of the same version would keep serving the old code.
+    commands.append('pkill -f "docker_remote.core.remotepy --serve" || true')
+
     commands.append('rm "' + host_archive_filename + '"')
     commands.append('exit $?')
 
     script = '\n'.join(x.format(pip=args.via) for x in commands)
-    return client.run_bash_script(script)
+    code = client.run_bash_script(script)
+
+    # Results of the previous version can not be trusted anymore.
+    result_cache = client.cache.ResultCache.from_config(client.get_remote_string())
+    if result_cache is not None:
+      result_cache.clear()
+      result_cache.save()
+    return code
 
   elif args.command == 'info':
     if args.host_version:
-      with client.Client() as cl:
+      with client.Client(create_tunnel=False) as cl:
         print(yaml.dump({'version': cl.get_host_version()}))
     else:
       print(yaml.dump(config.data))
@@ -367,3 +577,6 @@ def main(argv=None, prog=None):
 
 
 _entry_point = lambda: sys.exit(main())
+
+if __name__ == '__main__':
+  _entry_point()
@@ -19,12 +19,21 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import collections
 import contextlib
+import fnmatch
+import hashlib
+import json
 import os
 import nr.fs
+import re
+import shlex
+import shutil
 import subprocess
+import sys
+import tempfile
 import yaml
-from . import log
+from . import agent, cache, log, multi, placement, rendercache, sync
 from .. import config, host
 from ..core import remotepy, tunnel
 from ..core.subprocess import shell_call, shell_convert, shell_popen
@@ -69,6 +78,92 @@ def get_remote_string():
   return host
 
 
+def get_remotes():
+  """
+  Returns an ordered dictionary that maps the names in the `remotes`
+  inventory to `(host, user)` tuples, applying the same default values
+  as #get_remote_config(). An entry is either a `user@host` string or a
+  dictionary with the keys `host` and `user`.
+  """
+
+  remotes = collections.OrderedDict()
+  for name, value in sorted(config.get('remotes', {}).items()):
+    if isinstance(value, str):
+      user, host = value.partition('@')[::2]
+      if not host:
+        user, host = '', user
+    else:
+      host, user = value.get('host', name), value.get('user')
+    if host != 'localhost' and not user:
+      user = 'root'
+    remotes[name] = (host, user or None)
+  return remotes
+
+
+def select_remotes(selector):
+  """
+  Returns a list of `(name, host, user)` tuples for the comma-separated
+  *selector*. Every item is a name or a glob pattern that is matched
+  against the `remotes` inventory (`all` selects every remote). An item
+  that is not in the inventory but contains an `@` is used as a host
+  string. Raises a #ValueError if an item selects nothing.
+  """
+
+  remotes = get_remotes()
+  result = collections.OrderedDict()
+  for item in filter(None, (x.strip() for x in selector.split(','))):
+    pattern = '*' if item == 'all' else item
+    names = [x for x in remotes if fnmatch.fnmatchcase(x, pattern)]
+    if names:
+      for name in names:
+        result[name] = remotes[name]
+    elif '@' in item:
+      user, host = item.partition('@')[::2]
+      result[item] = (host, user)
+    else:
+      raise ValueError('no remote matches {!r}'.format(item))
+  return [(name, host, user) for name, (host, user) in result.items()]
+
+
+def get_ssh_options():
+  """
+  Returns the options for the `ssh` and `scp` commands. Unless disabled with
+  the `ssh.control_master` option, all connections to a host share a single
+  OpenSSH ControlMaster connection.
+  """
+
+  if not config.get('ssh.control_master', os.name != 'nt'):
+    return []
+  control_path = os.path.expanduser(config.get('ssh.control_path', '~/.cache/docker-remote/ssh/%C'))
+  os.makedirs(os.path.dirname(control_path), mode=0o700, exist_ok=True)
+  return tunnel.control_master_options(control_path,
+    config.get('ssh.control_persist', '10m'))
+
+
+def get_ssh_command(*argv):
+  """
+  Returns the `ssh` command to run *argv* on the configured host.
+  """
+
+  return ['ssh'] + get_ssh_options() + [get_remote_string()] + list(argv)
+
+
+def get_negotiate_options():
+  """
+  Returns the options for the remotepy handshake from the configuration, or
+  #None if no handshake should be performed.
+  """
+
+  compression = config.get('remote.compression', None)
+  if compression is None:
+    return None
+  return {
+    'compression': None if compression == 'none' else compression,
+    'threshold': config.get('remote.compression_threshold', 4096),
+    'oob_threshold': config.get('remote.oob_threshold', 65536),
+  }
+
+
 def create_remotepy_client(host=None, user=None, tool_name=None):
   """
   Creates a new RemotePy client for the configured host.
@@ -77,20 +172,31 @@ def create_remotepy_client(host=None, user=None, tool_name=None):
   if host is None and user is None:
     host, user = get_remote_config()
 
+  multiplex = config.get('remote.multiplex', False)
+  daemon = config.get('remote.daemon', False)
+  negotiate = get_negotiate_options()
   if host == 'localhost' and not user:
     log.info('Creating local RemotePy client.')
-    return remotepy.LocalClient()
+    return remotepy.LocalClient(multiplex=multiplex, daemon=daemon,
+      negotiate=negotiate)
   else:
     log.info('Creating SSH RemotePy client ({}@{}).'.format(user, host))
-    return remotepy.SSHClient(host, user, None, tool_name=tool_name)
+    return remotepy.SSHClient(host, user, None, tool_name=tool_name,
+      multiplex=multiplex, daemon=daemon, negotiate=negotiate,
+      bootstrap=config.get('remote.bootstrap', False),
+      python=config.get('remote.python', 'python3'),
+      ssh_options=get_ssh_options())
 
 
 def create_docker_tunnel(host=None, user=None, local_port=None,
-                         remote_port=None):
+                         remote_port=None, replaces=None):
   """
   Creates an SSH tunnel for the Docker daemon on the remote machine. Returns
   a #DockerTunnel instance. Note that the #DockerTunnel instance may be empty
   if no tunnel needs to be created.
+
+  If *replaces* is a closed tunnel, the new tunnel takes over its local port
+  or socket, thus a `DOCKER_HOST` that was handed out stays valid.
   """
 
   if host is None and user is None:
@@ -99,30 +205,216 @@ def create_docker_tunnel(host=None, user=None, local_port=None,
     log.info('Skipping Docker SSH Tunnel on localhost.')
     return DockerTunnel.none()  # No tunnel required
 
-  # TODO: Choose a random local port.
-  local_port = config.get('tunnel.local_port', 2375)
-  remote_port = config.get('tunnel.remote_port', '/var/run/docker.sock')
+  socket_dir = None
+  if replaces is not None:
+    local_port, socket_dir = replaces.local_port, replaces.socket_dir
+    if socket_dir:
+      os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+
+  if config.get('tunnel.mode', 'ssh') == 'dial-stdio':
+    ssh_options = get_ssh_options()
+    # Without a ControlMaster, every Docker API connection would pay for a
+    # full SSH handshake.
+    if tunnel.uses_control_master(ssh_options):
+      if not socket_dir:
+        socket_dir = tempfile.mkdtemp(prefix='docker-remote-')
+      log.info('Creating Docker forwarder via dial-stdio on {}@{}.'.format(user, host))
+      return DockerDialStdioTunnel(host, user, socket_dir, ssh_options)
+    log.warn('tunnel.mode dial-stdio requires ssh.control_master, using an SSH tunnel instead.')
+
+  if local_port is None:
+    local_port = config.get('tunnel.local_port', None)
+  if remote_port is None:
+    remote_port = config.get('tunnel.remote_port', '/var/run/docker.sock')
+  if local_port is None:
+    # Every session gets its own port or socket, thus many sessions can
+    # run at the same time.
+    if config.get('tunnel.local_socket', False) and os.name != 'nt':
+      socket_dir = tempfile.mkdtemp(prefix='docker-remote-')
+      local_port = os.path.join(socket_dir, 'docker.sock')
+    else:
+      local_port = tunnel.find_free_port()
   log.info('Creating Docker SSH Tunnel {}:{} on {}@{}.'.format(
     local_port, remote_port, user, host))
-  return DockerTunnel(host, user, None, local_port, remote_port)
+  return DockerTunnel(host, user, None, local_port, remote_port,
+    get_ssh_options(), socket_dir)
+
+
+#: docker-compose commands that do not change the deployment. Other
+#: commands invalidate the deploy fingerprint (see #Client.compose()).
+READONLY_COMPOSE_COMMANDS = ('config', 'events', 'exec', 'images', 'logs',
+  'port', 'ps', 'top', 'version')
+
+
+def get_compose_command(argv):
+  """
+  Returns the docker-compose command in *argv*, for example `up`.
+  """
+
+  return next((x for x in argv if not x.startswith('-')), None)
+
+
+def get_deploy_fingerprint(compose_yaml, argv, env=None):
+  """
+  Returns the fingerprint of a deployment with the rendered *compose_yaml*,
+  the docker-compose *argv* and the *env* that the compose file is
+  interpolated with (see #get_compose_env()).
+  """
+
+  data = '\0'.join([compose_yaml, json.dumps(list(argv)),
+    json.dumps(env or {}, sort_keys=True)])
+  return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+
+#: Matches a variable reference (or a `$$` escape) in a compose file.
+_VARIABLE_REGEX = re.compile(r'\$(?:\$|\{?([A-Za-z_][A-Za-z0-9_]*))')
+
+
+def read_env_file(filename):
+  """
+  Reads the `KEY=VALUE` lines of an env file like the `.env` file or the
+  `env_file` of a service. Empty lines and comments are skipped. Returns
+  a dictionary, where the value of a line without `=` is #None.
+  """
+
+  result = collections.OrderedDict()
+  with open(filename) as fp:
+    for line in fp:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      key, sep, value = line.partition('=')
+      value = value.strip() if sep else None
+      if value and len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        value = value[1:-1]
+      result[key.strip()] = value
+  return result
+
+
+def get_local_env(directory='.'):
+  """
+  Returns the environment that docker-compose uses when it runs in the
+  *directory*: the variables of the `.env` file, overridden by the
+  environment of the process.
+  """
+
+  env = {}
+  filename = os.path.join(directory, '.env')
+  if os.path.isfile(filename):
+    env.update((k, v) for k, v in read_env_file(filename).items() if v is not None)
+  env.update(os.environ)
+  return env
+
+
+def get_compose_env(compose_yaml, directory='.'):
+  """
+  Returns the values of the variables that docker-compose substitutes in
+  the *compose_yaml* when it runs in the *directory* (see
+  #get_local_env()). Variables that are not set are omitted.
+  """
+
+  env = get_local_env(directory)
+  names = set(x for x in _VARIABLE_REGEX.findall(compose_yaml) if x)
+  return {k: env[k] for k in sorted(names) if k in env}
+
+
+def compose_runs_on_host(argv, on_host=None):
+  """
+  Returns #True if docker-compose with *argv* should be run on the host.
+  If *on_host* is #None, the `compose.on_host` option is used. Commands
+  that need a terminal are always run locally.
+  """
+
+  if on_host is None:
+    on_host = config.get('compose.on_host', False)
+  return bool(on_host) and get_compose_command(argv) not in ('exec', 'run', 'attach')
 
 
 def run_bash_script(script):
-  command = ['ssh', get_remote_string(), 'bash', '-s']
+  command = get_ssh_command('bash', '-s')
   proc = shell_popen(command, stdin=subprocess.PIPE)
   proc.communicate(script.encode())
   return proc.returncode
 
 
 def send_file(src, dst):
-  command = ['scp', src, get_remote_string() + ':' + dst]
+  """
+  Sends the local file *src* to *dst* on the host. With `remote.bootstrap`,
+  the file is sent over a remotepy session (see #Client.put_file()).
+  Otherwise docker-remote may not be installed on the host yet, and the
+  file is sent with `scp`.
+  """
+
+  if config.get('remote.bootstrap', False):
+    with Client(create_tunnel=False) as cl:
+      try:
+        cl.put_file(src, dst)
+      except (IOError, EOFError) as exc:
+        log.error('Sending "{}" failed: {}'.format(src, exc))
+        return 1
+    return 0
+  command = ['scp'] + get_ssh_options() + [src, get_remote_string() + ':' + dst]
   return shell_call(command)
 
 
+def send_blob(src, dst):
+  """
+  Like #send_file(), but the file goes through the blob store on the host
+  (see #host.blobs) and is only transferred if the host does not have a
+  file with the same content yet. Without `remote.bootstrap`, the store is
+  accessed with plain `ssh` and `scp` commands, and the hash of an upload
+  is checked with `sha256sum` before it is added to the store.
+  """
+
+  if config.get('remote.bootstrap', False):
+    with Client(create_tunnel=False) as cl:
+      try:
+        digest = cl.upload_blobs([src])[0]
+        cl.remote.call(host.blobs.link_blob, digest, dst)
+      except (IOError, EOFError) as exc:
+        log.error('Sending "{}" failed: {}'.format(src, exc))
+        return 1
+    return 0
+
+  # The host may have no docker-remote to ask for the path of its store.
+  digest = host.sync.hash_file(src)
+  project_root = config.get('host.project_root', '~/docker-remote-projects')
+  if project_root.startswith('~/'):
+    blob_dir = '"$HOME"/' + shlex.quote(project_root[2:] + '/.blobs')
+  else:
+    blob_dir = shlex.quote(project_root + '/.blobs')
+  blob = '{}/{}'.format(blob_dir, digest)
+  if shell_call(get_ssh_command('test -f ' + blob)) != 0:
+    log.info('Uploading "{}" ({}).'.format(src, digest[:12]))
+    code = shell_call(get_ssh_command('mkdir -p ' + blob_dir))
+    part = blob + '.part'
+    if code == 0:
+      code = send_file(src, project_root + '/.blobs/' + digest + '.part')
+    if code == 0:
+      code = run_bash_script(
+        'if [ "$(sha256sum < {part} | cut -d" " -f1)" != {digest} ]; then\n'
+        '  echo "checksum mismatch for {part}" >&2; rm -f {part}; exit 1\n'
+        'fi\n'
+        'mv {part} {blob}\n'.format(part=part, digest=digest, blob=blob))
+    if code != 0:
+      return code
+  return shell_call(get_ssh_command('cp ' + blob + ' ' + shlex.quote(dst)))
+
+
 class DockerTunnel(tunnel.SSHTunnel):
+  """
+  The SSH tunnel to the Docker daemon. If *socket_dir* is specified, it is
+  the temporary directory that contains the local socket and it is removed
+  when the tunnel is closed.
+  """
 
   __is_empty = False
 
+  def __init__(self, host, user, password, local_port, remote_port,
+               ssh_options=None, socket_dir=None):
+    super().__init__(host, user, password, local_port, remote_port, ssh_options)
+    self.socket_dir = socket_dir
+
   def __enter__(self):
     if self.__is_empty:
       return self
@@ -131,7 +423,16 @@ class DockerTunnel(tunnel.SSHTunnel):
   def __exit__(self, *a):
     if self.__is_empty:
       return
-    return super().__exit__(*a)
+    try:
+      return super().__exit__(*a)
+    finally:
+      if self.socket_dir:
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+  def wait_ready(self, timeout=30):
+    if self.__is_empty:
+      return
+    return super().wait_ready(timeout)
 
   def __bool__(self):
     return not self.__is_empty
@@ -142,6 +443,8 @@ class DockerTunnel(tunnel.SSHTunnel):
   def docker_host(self):
     if self.__is_empty:
       return None
+    if tunnel.is_socket_path(self.local_port):
+      return 'unix://{}'.format(self.local_port)
     return 'tcp://localhost:{}'.format(self.local_port)
 
   @classmethod
@@ -151,9 +454,46 @@ class DockerTunnel(tunnel.SSHTunnel):
     return instance
 
 
+class DockerDialStdioTunnel(tunnel.DialStdioTunnel):
+  """
+  Forwards a Unix socket in the temporary *socket_dir* to the Docker daemon
+  with the #tunnel.DialStdioTunnel. The directory is removed when the
+  tunnel is closed, and the traffic statistics are logged.
+  """
+
+  def __init__(self, host, user, socket_dir, ssh_options=None):
+    super().__init__(host, user, os.path.join(socket_dir, 'docker.sock'), ssh_options)
+    self.socket_dir = socket_dir
+
+  def __exit__(self, *a):
+    try:
+      return super().__exit__(*a)
+    finally:
+      shutil.rmtree(self.socket_dir, ignore_errors=True)
+      if self.stats:
+        message = 'Docker API traffic: ' + tunnel.format_stats(self.stats)
+        if config.get('tunnel.stats', False):
+          print(message, file=sys.stderr)
+        else:
+          log.info(message)
+
+  @property
+  def docker_host(self):
+    return 'unix://{}'.format(self.local_socket)
+
+
 class Client:
   """
   This class wraps the docker-remote client workflow.
+
+  The Docker tunnel is started when the client is entered, but the client
+  does not wait for it to become ready until #wait_tunnel() is called. The
+  remotepy session is only opened on the first remote call, thus it is
+  established while the tunnel is still connecting, and not at all for
+  commands that do not need it.
+
+  If an agent is used for the host (see #agent.find_agent()), the calls
+  are sent to the agent and its tunnel is used instead.
   """
 
   def __init__(self, host=None, user=None, local_port=None, remote_port=None,
@@ -166,16 +506,23 @@ class Client:
     self.remote_port = remote_port
     self.create_tunnel = create_tunnel
     self.tool_name = tool_name or config.get('remote.remotepy', None)
-    self.remote = None
     self.tunnel = None
+    self._remote = None
+    self._agent_path = None
     self._stack = None
     self._remote_path = None
+    self._cache = NotImplemented
 
   def __enter__(self):
     self._stack = contextlib.ExitStack()
     self._stack.__enter__()
-    self.remote = self._stack.enter_context(create_remotepy_client(self.host, self.user, self.tool_name))
-    if self.create_tunnel:
+    host, user = self.host, self.user
+    if host is None and user is None:
+      host, user = get_remote_config()
+    self._agent_path = agent.find_agent(host, user)
+    if self._agent_path and self.create_tunnel:
+      self.tunnel = agent.AgentTunnel(self.remote.call(agent.get_docker_host))
+    elif self.create_tunnel:
       self.tunnel = self._stack.enter_context(create_docker_tunnel(self.host, self.user, self.local_port, self.remote_port))
     if self.tunnel and self.tunnel.docker_host:
       os.environ['DOCKER_HOST'] = self.tunnel.docker_host
@@ -184,6 +531,64 @@ class Client:
   def __exit__(self, *a):
     return self._stack.__exit__(*a)
 
+  @property
+  def remote(self):
+    """
+    The remotepy client. The session is opened on first access.
+    """
+
+    if self._remote is None:
+      if self._agent_path:
+        remote = agent.AgentClient(self._agent_path)
+      else:
+        remote = create_remotepy_client(self.host, self.user, self.tool_name)
+      self._remote = self._stack.enter_context(remote)
+    return self._remote
+
+  def wait_tunnel(self, timeout=None):
+    """
+    Waits until the Docker tunnel accepts connections. Does nothing if no
+    tunnel was created.
+    """
+
+    if self.tunnel:
+      if timeout is None:
+        timeout = config.get('tunnel.timeout', 30)
+      self.tunnel.wait_ready(timeout)
+
+  @property
+  def cache(self):
+    """
+    The #cache.ResultCache for the host, or #None if caching is disabled.
+    """
+
+    if self._cache is NotImplemented:
+      self._cache = cache.ResultCache.from_config(self.host_string)
+    return self._cache
+
+  @property
+  def host_string(self):
+    host, user = self.host, self.user
+    if host is None and user is None:
+      host, user = get_remote_config()
+    return '{}@{}'.format(user, host) if user else host
+
+  def cached_call(self, __func, *args, **kwargs):
+    """
+    Calls *__func* on the remote, unless its result is in the #cache.
+    """
+
+    return self.cached_call_many([(__func, args, kwargs)])[0]
+
+  def cached_call_many(self, calls):
+    """
+    Like #call_many(), but results are taken from the #cache where possible.
+    """
+
+    if self.cache is None:
+      return self.remote.call_many(calls)
+    return self.cache.call_many(self, calls)
+
   @property
   def remote_path(self):
     """
@@ -191,11 +596,12 @@ class Client:
     """
 
     if self._remote_path is None:
-      modname = self.remote.call(remotepy.get_module_member, 'os.path', '__name__')
+      modname = self.cached_call(remotepy.get_module_member, 'os.path', '__name__')
       self._remote_path = __import__(modname, fromlist=[None])
     return self._remote_path
 
-  def process_docker_compose(self, compose_config, create_volumedirs=True):
+  def process_docker_compose(self, compose_config, create_volumedirs=True,
+                             create_project=False):
     """
     Preprocesses a docker-compose configuration. Returns a dictionary with
     the following data:
@@ -204,13 +610,17 @@ class Client:
       for volume mappings.
 
     If *create_volumedirs* is #True, volume directories will be immediately
-    created.
+    created. If *create_project* is #True, the project will be created on
+    the remote if it does not already exist.
+
+    The whole preprocessing costs a single round trip (see
+    #host.projects.prepare_project()), regardless of the number of services
+    and volumes.
     """
 
     version = compose_config.get('version')
     project_name = config.get('project.name')
-    prefix = self.remote.call(host.projects.get_project_path, project_name)
-    volume_dirs = []
+    add_dockerhost = config.get('project.add_dockerhost', False)
 
     if not version:  # Compose file 1
       services = compose_config
@@ -219,35 +629,40 @@ class Client:
     else:
       raise RuntimeError('unknown compose file version: {!r}'.format(version))
 
-    # Update relative volumes.
+    # Collect the volume sources, they are resolved on the remote.
+    volume_specs = []
     for service in services.items():
       volumes = service[1].get('volumes', [])
       for i, volume in enumerate(volumes):
         if isinstance(volume, str):
           source = volume
-          def update(x): volumes[i] = x
+          def update(x, volumes=volumes, i=i): volumes[i] = x
         elif isinstance(volume, dict):
           source = volume['source']
-          def update(x): volume['source'] = x
+          def update(x, volume=volume): volume['source'] = x
         else:
           continue
 
         if ':' not in source:
           raise ValueError('invalid volume: {!r}'.format(volume))
         lv, cv = source.rpartition(':')[::2]
+        volume_specs.append((lv, cv, update))
 
-        # Only convert relative paths that are NOT named volumes.
-        if not self.remote_path.isabs(lv) and '/' in lv:
-          lv = self.remote_path.join(prefix, lv)
-          update(lv + ':' + cv)
+    info = self.remote.call(host.projects.prepare_project, project_name,
+      [x[0] for x in volume_specs], create_project=create_project,
+      create_volumedirs=create_volumedirs, docker_host_ip=bool(add_dockerhost))
+    if self._remote_path is None:
+      self._remote_path = __import__(info['path_module'], fromlist=[None])
 
-        if volume_dirs is not None:
-          volume_dirs.append(lv)
+    # Update relative volumes.
+    for (lv, cv, update), resolved in zip(volume_specs, info['volumes']):
+      if resolved != lv:
+        update(resolved + ':' + cv)
 
     # Add dockerhost host entries.
-    services = config.get('project.add_dockerhost', False)
+    services = add_dockerhost
+    ip = info['docker_host_ip']
     if services:
-      ip = self.remote.call(host.dockerhost.get_docker_host_ip)
       if not ip:
         raise RuntimeError('Unable to determine Docker Host IP')
       if services is True:
@@ -258,31 +673,133 @@ class Client:
           log.info('Adding services.{}.extra_hosts: "dockerhost:{}"'.format(service[0], ip))
           extra_hosts.append('dockerhost:{}'.format(ip))
 
-    if create_volumedirs:
-      self.remote.call(host.projects.ensure_volume_dirs, project_name, volume_dirs)
+    return {'volume_dirs': info['volumes'], 'docker_host_ip': ip,
+            'deploy_fingerprint': info['deploy_fingerprint']}
 
-    return {'volume_dirs': volume_dirs}
+  def render(self, compose_config, file_hash=None, create_project=False):
+    """
+    Renders the *compose_config* with #process_docker_compose(). Returns a
+    dictionary with the keys `yaml` (the rendered compose file), `filename`
+    (a file that contains the rendered compose file or #None),
+    `volume_dirs`, `docker_host_ip` and `deploy_fingerprint` (only if
+    *create_project* is #True).
+
+    If the *file_hash* of the compose file is specified, the rendered file
+    is cached (see #rendercache.RenderCache) unless the
+    `compose.render_cache` option is disabled. On a cache hit, the
+    *compose_config* is not processed. If *create_project* is #True, the
+    project is still prepared on the host in that case, and the compose
+    file is rendered again if the Docker host IP changed.
+    """
 
-  def compose(self, argv, compose_config=None, preprocess=True):
-    with contextlib.ExitStack() as stack:
+    render_cache, key = None, None
+    if file_hash and config.get('compose.render_cache', True):
+      render_cache = rendercache.RenderCache()
+      key = render_cache.get_key(file_hash, self.host_string)
+      entry = render_cache.get(key)
+      if entry is not None and not create_project:
+        return entry
+      elif entry is not None:
+        info = self.remote.call(host.projects.prepare_project,
+          config.get('project.name'), entry['volume_dirs'], create_project=True,
+          docker_host_ip=entry['docker_host_ip'] is not None)
+        if info['docker_host_ip'] == entry['docker_host_ip']:
+          return dict(entry, deploy_fingerprint=info['deploy_fingerprint'])
+        log.info('Docker host IP changed, rendering docker-compose.yml again.')
+
+    result = self.process_docker_compose(compose_config, create_project=create_project)
+    compose_yaml = rendercache.dump_yaml(compose_config)
+    entry = None
+    if render_cache is not None:
+      entry = render_cache.put(key, compose_yaml, result['volume_dirs'], result['docker_host_ip'])
+    if entry is None:
+      entry = dict(result, yaml=compose_yaml, filename=None)
+    entry['deploy_fingerprint'] = result['deploy_fingerprint']
+    return entry
+
+  def compose(self, argv, compose_config=None, preprocess=True, on_host=None,
+              file_hash=None, force_deploy=False):
+    """
+    Runs docker-compose with *argv*. If #compose_runs_on_host() returns
+    #True, docker-compose is run on the host with the rendered
+    *compose_config* and its output is streamed back. Otherwise, it is run
+    locally through the tunnel. See #render() for *file_hash*.
+
+    After a successful `up`, the fingerprint of the rendered configuration,
+    the variables it is interpolated with and the arguments is stored in
+    the project directory on the host. A subsequent `up` with the same
+    fingerprint is skipped if every service of the project has a running
+    container, unless *force_deploy* is #True. Commands that may change the
+    deployment (like `down` or `pull`) remove the fingerprint.
+
+    If the `compose.push_volumes` option is set, the local sources of the
+    relative volumes are uploaded before `up` (see #sync.push_volumes()).
+    """
+
+    project_name = config.get('project.name')
+    on_host = compose_config is not None and compose_runs_on_host(argv, on_host)
+    if on_host:
+      self._check_host_compose(compose_config)
+
+    # Collected before the relative volumes are rewritten.
+    push_volumes = None
+    if compose_config is not None and get_compose_command(argv) == 'up' and \
+        config.get('compose.push_volumes', False):
+      push_volumes = sync.get_relative_volumes(compose_config)
+
+    rendered = None
+    if compose_config is not None and preprocess:
+      rendered = self.render(compose_config, file_hash, create_project=True)
+    else:
       if compose_config is not None:
-        if preprocess:
-          self.process_docker_compose(compose_config)
+        rendered = {'yaml': rendercache.dump_yaml(compose_config), 'filename': None}
+      if not self.project_exists(project_name):
+        self.new_project(project_name)
+    if rendered is not None:
+      log.debug('Final docker-compose.yml:\n\n%s', rendered['yaml'])
+
+    if push_volumes:
+      code = sync.push_volumes(self, project_name, push_volumes,
+        compression=config.get('scp.compress', 'gzip'),
+        level=config.get('scp.compress_level', None),
+        jobs=config.get('scp.jobs', 4),
+        blob_threshold=config.get('scp.blob_threshold', 1024 * 1024))
+      if code != 0:
+        return code
+
+    fingerprint = None
+    deployed = rendered.get('deploy_fingerprint') if rendered else None
+    subcommand = get_compose_command(argv)
+    resolved = None
+    if on_host or (rendered is not None and preprocess and subcommand == 'up'):
+      resolved = self._resolve_compose(rendered['yaml'])
+    if rendered is not None and preprocess and subcommand == 'up':
+      fingerprint = get_deploy_fingerprint(resolved[0], argv, resolved[1])
+      if fingerprint == deployed and not force_deploy and \
+          self._is_running(project_name, compose_config):
+        print('Project {!r} is up to date, skipping "docker-compose up". Use '
+          '--force-deploy to deploy anyway.'.format(project_name), file=sys.stderr)
+        return 0
+    if deployed is not None and subcommand not in READONLY_COMPOSE_COMMANDS:
+      # Removed first, so a failed deployment is not mistaken for the last
+      # successful one.
+      self.remote.call(host.projects.set_deploy_fingerprint, project_name, None)
+
+    if on_host:
+      return self._compose_on_host(argv, resolved[0], resolved[1], fingerprint)
+
+    with contextlib.ExitStack() as stack:
+      filename = rendered['filename'] if rendered else None
+      if rendered is not None and filename is None:
         fp = stack.enter_context(nr.fs.tempfile('.yaml', text=True))
-        fp.write(yaml.dump(compose_config))
+        fp.write(rendered['yaml'])
         fp.close()
-        log.debug('Final docker-compose.yml:\n\n%s', yaml.dump(compose_config))
-      else:
-        fp = None
+        filename = fp.name
 
       env = os.environ.copy()
-      project_name = config.get('project.name')
-      if not self.project_exists(project_name):
-        self.new_project(project_name)
-
       command = ['docker-compose', '-p', project_name]
-      if fp:
-        command += ['-f', fp.name]
+      if filename:
+        command += ['-f', filename]
       command += ['--project-directory', '.']
       command += argv
 
@@ -295,11 +812,100 @@ class Client:
         # a Linux docker daemon.
         env['COMPOSE_CONVERT_WINDOWS_PATHS'] = '1'
 
+      self.wait_tunnel()
       log.info('$ ' + shell_convert(command))
-      return shell_call(command, env=env)
+      code = shell_call(command, env=env)
+      if code == 0 and fingerprint is not None:
+        self.remote.call(host.projects.set_deploy_fingerprint, project_name, fingerprint)
+      return code
+
+  def _check_host_compose(self, compose_config):
+    services = compose_config.get('services', compose_config)
+    for name, service in services.items():
+      if isinstance(service, dict) and 'build' in service:
+        raise RuntimeError('service {!r} has a build context, which is not '
+          'available when docker-compose runs on the host'.format(name))
+    for key in ('configs', 'secrets'):
+      for name, value in (compose_config.get(key) or {}).items():
+        filename = value.get('file') if isinstance(value, dict) else None
+        if filename and not os.path.isabs(filename):
+          raise RuntimeError('{} {!r} refers to the local file {!r}, which is not '
+            'available when docker-compose runs on the host'.format(key[:-1], name, filename))
+
+  def _is_running(self, project_name, compose_config):
+    # Returns #True if every service has a running container on the host.
+    running = self.remote.call(host.projects.get_running_services, project_name)
+    if running is None:
+      return False
+    services = compose_config.get('services', {}) \
+      if compose_config.get('version') else compose_config
+    missing = set(services) - set(running)
+    if missing:
+      log.info('Services without a running container: {}'.format(', '.join(sorted(missing))))
+    return not missing
+
+  def _resolve_compose(self, compose_yaml):
+    """
+    Returns the *compose_yaml* and the environment that it is interpolated
+    with as docker-compose would on the client, so that docker-compose on
+    the host behaves the same. The `env_file` of every service is read
+    locally and merged into its `environment`, together with the local
+    values of the variables that the `environment` takes from the shell.
+    """
+
+    env = get_compose_env(compose_yaml)
+    local_env = get_local_env()
+    compose_config = yaml.safe_load(compose_yaml)
+    services = compose_config.get('services', {}) \
+      if compose_config.get('version') else compose_config
+    changed = False
+    for service in services.values():
+      if not isinstance(service, dict):
+        continue
+      env_files = service.pop('env_file', None)
+      environment = service.get('environment')
+      if env_files is None and not environment:
+        continue
+      values = collections.OrderedDict()
+      for filename in [env_files] if isinstance(env_files, str) else env_files or []:
+        for key, value in read_env_file(filename).items():
+          # The values of an env_file are not interpolated by docker-compose.
+          values[key] = None if value is None else value.replace('$', '$$')
+      if isinstance(environment, dict):
+        values.update(environment)
+      else:
+        for item in environment or []:
+          key, sep, value = item.partition('=')
+          values[key] = value if sep else None
+      for key, value in list(values.items()):
+        # Variables without a value are taken from the environment.
+        if value is None and key in local_env:
+          values[key] = local_env[key].replace('$', '$$')
+        elif value is None:
+          del values[key]
+      service['environment'] = dict(values)
+      changed = True
+    if changed:
+      compose_yaml = rendercache.dump_yaml(compose_config)
+    return compose_yaml, env
+
+  def _compose_on_host(self, argv, compose_yaml, env, deploy_fingerprint=None):
+    project_name = config.get('project.name')
+    command = shlex.split(config.get('compose.host_command', 'docker-compose'))
+    log.info('$ ' + shell_convert(command + argv) + ' (on the host)')
+    stream = self.remote.call(host.compose.run_compose, project_name,
+      compose_yaml, argv, command, deploy_fingerprint, env)
+    outputs = {'stdout': sys.stdout.buffer, 'stderr': sys.stderr.buffer}
+    for name, data in stream:
+      outputs[name].write(data)
+      outputs[name].flush()
+    return stream.value
+
+  def call_many(self, calls, return_exceptions=False):
+    return self.remote.call_many(calls, return_exceptions)
 
   def get_host_version(self):
-    return self.remote.call(host.get_version)
+    return self.cached_call(host.get_version)
 
   def list_projects(self):
     return self.remote.call(host.projects.list_projects)
@@ -314,7 +920,90 @@ class Client:
     return self.remote.call(host.projects.remove_project, project)
 
   def get_project_path(self, project):
-    return self.remote.call(host.projects.get_project_path, project)
+    return self.cached_call(host.projects.get_project_path, project)
 
   def get_volume_path(self, project, volume):
-    return self.remote.call(host.projects.get_volume_path, project, volume)
+    return self.cached_call(host.projects.get_volume_path, project, volume)
+
+  def put_file(self, src, dst, chunk_size=host.files.CHUNK_SIZE, window=8):
+    """
+    Uploads the local file *src* to *dst* on the host over the remotepy
+    session. Up to *window* chunks are sent in a single round trip. The
+    checksum is verified on the host before the file is moved into place.
+    """
+
+    hasher = hashlib.sha256()
+    offset = 0
+    batch = []
+    with open(src, 'rb') as fp:
+      while True:
+        buf = bytearray(chunk_size)
+        n = fp.readinto(buf)
+        if n < chunk_size:
+          del buf[n:]
+        if n:
+          hasher.update(buf)
+          batch.append((host.files.write_chunk, (dst, offset, buf)))
+          offset += n
+        if batch and (not n or len(batch) >= window):
+          self.remote.call_many(batch)
+          batch = []
+        if not n:
+          break
+    # The calls of a batch may run concurrently, thus the file is only
+    # completed once all of its chunks are written.
+    mode = os.stat(src).st_mode & 0o777
+    self.remote.call(host.files.finish_put, dst, offset, hasher.hexdigest(), mode)
+
+  def get_file(self, src, dst, chunk_size=host.files.CHUNK_SIZE):
+    """
+    Downloads the file *src* from the host to the local file *dst* over
+    the remotepy session. The file is streamed in chunks and its checksum
+    is verified before it is moved into place.
+    """
+
+    hasher = hashlib.sha256()
+    tmpfile = '{}.{}'.format(dst, os.getpid())
+    stream = self.remote.call(host.files.get_file, src, chunk_size)
+    try:
+      with open(tmpfile, 'wb') as fp:
+        for chunk in stream:
+          hasher.update(chunk)
+          fp.write(chunk)
+      size, digest = stream.value
+      if digest != hasher.hexdigest():
+        raise IOError('checksum mismatch for {!r}'.format(src))
+      os.replace(tmpfile, dst)
+    except BaseException:
+      stream.close()
+      if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+      raise
+
+  def upload_blobs(self, filenames):
+    """
+    Uploads the local *filenames* to the blob store on the host (see
+    #host.blobs), skipping the files whose content is already stored. The
+    missing hashes are determined in a single call. Returns the hashes of
+    the files.
+    """
+
+    digests = [host.sync.hash_file(x) for x in filenames]
+    missing = self.remote.call(host.blobs.missing_blobs, sorted(set(digests)))
+    for filename, digest in zip(filenames, digests):
+      if digest in missing:
+        log.info('Uploading "{}" ({}).'.format(filename, digest[:12]))
+        self.put_file(filename, missing.pop(digest))
+    return digests
+
+  def get_manifests(self, paths):
+    """
+    Returns the #host.sync.get_manifest() of every directory in *paths* in
+    a single round trip.
+    """
+
+    return self.remote.call_many([(host.sync.get_manifest, (x,)) for x in paths])
+
+  def get_volume_paths(self, project, volumes):
+    return self.cached_call_many([
+      (host.projects.get_volume_path, (project, volume)) for volume in volumes])
@@ -0,0 +1,345 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+A local per-host agent that keeps the Docker tunnel and the remotepy session
+warm across CLI invocations. The agent serves the remotepy protocol on a
+Unix socket and forwards all calls to its remotepy session, except for the
+functions in this module, which are executed by the agent itself.
+
+The agent shuts down when no client has been connected for the idle
+timeout. Note that the agent uses the configuration from when it was
+started.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import yaml
+
+from . import log
+from .. import client, config
+from ..core import remotepy
+
+#: The directory that contains the agent sockets.
+AGENTS_DIR = os.path.expanduser('~/.cache/docker-remote/agents')
+
+#: The environment variable that contains the configuration for the agent
+#: process, and the one that tells CLI invocations to use an agent.
+CONFIG_VAR = 'DOCKER_REMOTE_AGENT_CONFIG'
+AGENT_VAR = 'DOCKER_REMOTE_AGENT'
+
+#: The #Agent of the current process.
+_agent = None
+
+
+def is_supported():
+  return hasattr(socket, 'AF_UNIX')
+
+
+def socket_path(host_string):
+  """
+  Returns the path of the agent socket for *host_string*.
+  """
+
+  digest = hashlib.sha1(host_string.encode('utf8')).hexdigest()[:16]
+  return os.path.join(AGENTS_DIR, digest + '.sock')
+
+
+def spawn_agent(host, user, idle_timeout=None):
+  """
+  Starts an agent for the host in a detached background process with the
+  current configuration.
+  """
+
+  host_string = '{}@{}'.format(user, host) if user else host
+  command = [sys.executable, '-m', 'docker_remote.client.agent',
+    '--host', host, '--socket', socket_path(host_string)]
+  if user:
+    command += ['--user', user]
+  if idle_timeout is not None:
+    command += ['--idle-timeout', str(idle_timeout)]
+  env = os.environ.copy()
+  env[CONFIG_VAR] = yaml.safe_dump(config.data)
+  return subprocess.Popen(command, stdin=subprocess.DEVNULL,
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True,
+    start_new_session=True, env=env)
+
+
+def start_agent(host, user, timeout=10):
+  """
+  Makes sure that an agent for the host is running and returns the path of
+  its socket.
+  """
+
+  host_string = '{}@{}'.format(user, host) if user else host
+  path = socket_path(host_string)
+  if remotepy.is_daemon_running(path):
+    return path
+  log.info('Starting docker-remote agent for {}.'.format(host_string))
+  proc = spawn_agent(host, user, config.get('agent.idle_timeout', 600))
+  deadline = time.time() + timeout
+  while not remotepy.is_daemon_running(path):
+    if proc.poll() is not None:
+      raise RuntimeError('docker-remote agent exited with {}'.format(proc.returncode))
+    if time.time() > deadline:
+      raise RuntimeError('docker-remote agent did not start within {} seconds'.format(timeout))
+    time.sleep(0.05)
+  return path
+
+
+def find_agent(host, user):
+  """
+  Returns the socket path of the agent that should be used for the host,
+  or #None if no agent should be used. The agent is used if it was started
+  by the `docker-remote shell` or if the `agent.enabled` option is set, in
+  which case it is started if it is not running.
+  """
+
+  if not is_supported():
+    return None
+  host_string = '{}@{}'.format(user, host) if user else host
+  path = socket_path(host_string)
+  if os.getenv(AGENT_VAR) == path and remotepy.is_daemon_running(path):
+    return path
+  if config.get('agent.enabled', False):
+    return start_agent(host, user)
+  return None
+
+
+def get_docker_host():
+  """
+  Executed in the agent. Waits until the tunnel is ready and returns the
+  value for `DOCKER_HOST`, or #None if no tunnel is needed.
+  """
+
+  tunnel = _agent.get_tunnel()
+  tunnel.wait_ready(config.get('tunnel.timeout', 30))
+  return tunnel.docker_host
+
+
+def _stream(iterator, lock=None, abort=None):
+  # Forwards the items of a #remotepy.RemoteIterator. The lock of a session
+  # that does not support concurrent calls is held until the stream ended.
+  # If the client goes away before that, *abort* is called instead of
+  # reading the rest of a stream that may never end (like `logs -f`).
+  waiting = False
+  try:
+    for item in iterator:
+      waiting = True
+      yield item
+      waiting = False
+    return iterator.value
+  finally:
+    if waiting and abort is not None:
+      abort()
+    else:
+      iterator.close()
+    if lock is not None:
+      lock.release()
+
+
+class Agent:
+  """
+  Serves the remotepy protocol on the Unix socket *path* and forwards the
+  calls to the remotepy session for the host.
+  """
+
+  def __init__(self, host, user, path, idle_timeout=600):
+    self.host = host
+    self.user = user
+    self.path = path
+    self.idle_timeout = idle_timeout
+    self.tunnel = None
+    self._stack = contextlib.ExitStack()
+    self._remote = None
+    self._session_lock = threading.Lock()
+    self._tunnel_lock = threading.Lock()
+    # Sessions without multiplexing can only handle one call at a time.
+    self._call_lock = None if config.get('remote.multiplex', False) else threading.Lock()
+
+  def _get_remote(self):
+    with self._session_lock:
+      if self._remote is None:
+        self._remote = self._stack.enter_context(
+          client.create_remotepy_client(self.host, self.user))
+      return self._remote
+
+  def get_tunnel(self):
+    """
+    Returns the Docker tunnel. A tunnel that is no longer alive, for example
+    because the SSH connection was lost, is replaced by a new one on the same
+    local port or socket, as shells may still use the old `DOCKER_HOST`.
+    """
+
+    with self._tunnel_lock:
+      if self.tunnel and self.tunnel.status() != 'alive':
+        log.info('Docker tunnel to {} lost, reconnecting.'.format(self.host))
+        old_tunnel = self.tunnel
+        self._close_tunnel()
+        self.tunnel = client.create_docker_tunnel(self.host, self.user,
+          replaces=old_tunnel).__enter__()
+      return self.tunnel
+
+  def _close_tunnel(self):
+    tunnel, self.tunnel = self.tunnel, None
+    if tunnel is not None:
+      try:
+        tunnel.__exit__(None, None, None)
+      except Exception as exc:
+        log.warn('Unable to close the Docker tunnel: {}'.format(exc))
+
+  def _reset_remote(self, remote):
+    with self._session_lock:
+      if self._remote is remote:
+        # The old session is cleaned up when the agent shuts down.
+        log.info('Remotepy session to {} lost.'.format(self.host))
+        self._remote = None
+
+  def _abort_remote(self, remote):
+    # Ends a session that can not cancel a single stream, the handler on
+    # the host stops the stream when the connection is closed.
+    self._reset_remote(remote)
+    try:
+      remote.__exit__(None, None, None)
+    except Exception as exc:
+      log.warn('Unable to close the remotepy session: {}'.format(exc))
+
+  def dispatch(self, request):
+    func = request['function']
+    args, kwargs = request['args'], request['kwargs']
+    if getattr(func, '__module__', None) == __name__:
+      return func(*args, **kwargs)
+    remote = self._get_remote()
+    if self._call_lock is not None:
+      self._call_lock.acquire()
+    try:
+      result = remote.call(func, *args, **kwargs)
+    except BaseException as exc:
+      if self._call_lock is not None:
+        self._call_lock.release()
+      if isinstance(exc, (EOFError, struct.error)):
+        # The connection is lost, the next call starts a new session.
+        self._reset_remote(remote)
+      raise
+    if isinstance(result, remotepy.RemoteIterator) and self._call_lock is not None:
+      return _stream(result, self._call_lock, lambda: self._abort_remote(remote))
+    if isinstance(result, remotepy.RemoteIterator):
+      return _stream(result)
+    if self._call_lock is not None:
+      self._call_lock.release()
+    return result
+
+  def _handler_class(self, base):
+    agent = self
+    class AgentHandler(base):
+      def _call(self, request):
+        return agent.dispatch(request)
+    return AgentHandler
+
+  def serve_forever(self):
+    global _agent
+    _agent = self
+    with self._stack:
+      # Both connect in the background while the agent starts serving.
+      self.tunnel = client.create_docker_tunnel(self.host, self.user).__enter__()
+      self._stack.callback(self._close_tunnel)
+      self._get_remote()
+      protocols = {k: self._handler_class(v) for k, v in remotepy.DAEMON_PROTOCOLS.items()}
+      server = remotepy.DaemonServer(self.path, self.idle_timeout, protocols=protocols)
+      server.serve_forever()
+
+
+class AgentClient:
+  """
+  A remotepy client for the agent listening on *path*.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def __enter__(self):
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.connect(self.path)
+    self._sock.sendall(b'2')
+    self._fread = self._sock.makefile('rb')
+    self._fwrite = self._sock.makefile('wb')
+    self._client = remotepy.MultiplexIoProtocolClient(self._fwrite, self._fread)
+    return self
+
+  def __exit__(self, *a):
+    self._fwrite.close()
+    self._sock.shutdown(socket.SHUT_WR)
+    self._client._reader_thread.join()
+    self._fread.close()
+    self._sock.close()
+
+  def call(self, *args, **kwargs):
+    return self._client.call(*args, **kwargs)
+
+  def call_many(self, *args, **kwargs):
+    return self._client.call_many(*args, **kwargs)
+
+
+class AgentTunnel:
+  """
+  Takes the place of the #client.DockerTunnel when the tunnel is provided
+  by an agent.
+  """
+
+  def __init__(self, docker_host):
+    self.docker_host = docker_host
+
+  def __bool__(self):
+    return self.docker_host is not None
+
+  __nonzero__ = __bool__
+
+  def wait_ready(self, timeout=30):
+    pass  # The agent waited for the tunnel.
+
+  def status(self):
+    return 'alive'
+
+
+def main(argv=None, prog=None):
+  parser = argparse.ArgumentParser(prog=prog)
+  parser.add_argument('--host', required=True)
+  parser.add_argument('--user')
+  parser.add_argument('--socket', required=True)
+  parser.add_argument('--idle-timeout', type=float, default=600)
+  args = parser.parse_args(argv)
+  if os.getenv(CONFIG_VAR):
+    config.merge(config.data, yaml.safe_load(os.environ[CONFIG_VAR]))
+  os.makedirs(os.path.dirname(args.socket), mode=0o700, exist_ok=True)
+  Agent(args.host, args.user, args.socket, args.idle_timeout).serve_forever()
+
+
+if __name__ == '__main__':
+  # See docker_remote.core.remotepy.
+  from docker_remote.client import agent
+  agent.main()
@@ -0,0 +1,198 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+An on-disk cache for the results of remote calls that give the same answer
+every time for a given host. Every host has its own cache file.
+
+The cached results are only used as long as the host version that was last
+seen is younger than the TTL of #host.get_version(). After that, the next
+round trip to the host asks for the version again, and if it changed, all
+cached results of the host are discarded.
+"""
+
+import json
+import os
+import time
+
+from . import log
+from .. import config, host
+from ..core import remotepy
+
+#: The directory that contains the cache files.
+CACHE_DIR = os.path.expanduser('~/.cache/docker-remote/results')
+
+#: The default TTLs in seconds of the functions whose results can be cached.
+#: Functions that are not listed here are never cached. The TTLs can be
+#: overwritten with the `cache.ttl` option, using the function name as key.
+DEFAULT_TTLS = {
+  host.get_version: 600,
+  host.projects.get_project_path: 3600,
+  host.projects.get_volume_path: 3600,
+  host.dockerhost.get_docker_host_ip: 600,
+  remotepy.get_module_member: 86400,
+}
+
+
+def get_function_name(func):
+  return '{}.{}'.format(func.__module__, func.__qualname__)
+
+
+class ResultCache:
+  """
+  The result cache for a single host. Changes are written to disk with
+  #save().
+  """
+
+  def __init__(self, host_string, ttls=None, directory=None):
+    self.host_string = host_string
+    self.ttls = {get_function_name(k): v for k, v in (ttls or DEFAULT_TTLS).items()}
+    self.filename = os.path.join(directory or CACHE_DIR,
+      host_string.replace(os.sep, '_') + '.json')
+    self._entries = None
+    self._changed = False
+
+  @classmethod
+  def from_config(cls, host_string):
+    """
+    Creates a #ResultCache for *host_string* that respects the `cache.enabled`
+    and `cache.ttl` options. Returns #None if the cache is disabled.
+    """
+
+    if not config.get('cache.enabled', True):
+      return None
+    ttls = dict(DEFAULT_TTLS)
+    overrides = config.get('cache.ttl', {})
+    for func in ttls:
+      ttls[func] = overrides.get(func.__name__, ttls[func])
+    return cls(host_string, ttls)
+
+  @property
+  def entries(self):
+    if self._entries is None:
+      try:
+        with open(self.filename) as fp:
+          self._entries = json.load(fp)
+      except FileNotFoundError:
+        self._entries = {}
+      except ValueError:
+        log.warn('Discarding corrupt result cache "{}".'.format(self.filename))
+        self._entries = {}
+    return self._entries
+
+  def _key(self, func, args, kwargs):
+    return json.dumps([get_function_name(func), list(args), kwargs], sort_keys=True)
+
+  def _is_fresh(self, key):
+    entry = self.entries.get(key)
+    return entry is not None and entry['expires'] > time.time()
+
+  def is_cacheable(self, func):
+    return self.ttls.get(get_function_name(func), 0) > 0
+
+  def is_validated(self):
+    """
+    Returns #True if the host version was checked within the TTL of
+    #host.get_version(). Otherwise, no cached results are returned.
+    """
+
+    return self._is_fresh(self._key(host.get_version, (), {}))
+
+  def get(self, func, args=(), kwargs=None):
+    """
+    Returns a tuple of a boolean that indicates whether a result was found
+    and the cached result.
+    """
+
+    if not self.is_cacheable(func) or not self.is_validated():
+      return False, None
+    key = self._key(func, args, kwargs or {})
+    if not self._is_fresh(key):
+      return False, None
+    return True, self.entries[key]['value']
+
+  def put(self, func, args, kwargs, value):
+    """
+    Stores the result of a call. If *func* is #host.get_version() and the
+    version differs from the previously seen version, all other results are
+    discarded.
+    """
+
+    if not self.is_cacheable(func):
+      return
+    key = self._key(func, args, kwargs or {})
+    if func is host.get_version:
+      entry = self.entries.get(key)
+      if entry is not None and entry['value'] != value:
+        log.info('Host version of {} changed, discarding cached results.'
+          .format(self.host_string))
+        self.entries.clear()
+    ttl = self.ttls[get_function_name(func)]
+    self.entries[key] = {'value': value, 'expires': time.time() + ttl}
+    self._changed = True
+
+  def clear(self):
+    self.entries.clear()
+    self._changed = True
+
+  def save(self):
+    if not self._changed:
+      return
+    os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+    tmpfile = '{}.{}'.format(self.filename, os.getpid())
+    with open(tmpfile, 'w') as fp:
+      json.dump(self.entries, fp)
+    os.replace(tmpfile, self.filename)
+    self._changed = False
+
+  def call_many(self, remote, calls):
+    """
+    Like #IoProtocolClient.call_many(), but cached results are used where
+    possible and only the remaining calls are sent to the *remote*. If the
+    host version needs to be checked again, the check is added to the same
+    round trip.
+    """
+
+    calls = [remotepy._normalize_call(x) for x in calls]
+    results = [None] * len(calls)
+    missing = []
+    for index, (func, args, kwargs) in enumerate(calls):
+      found, value = self.get(func, args, kwargs)
+      if found:
+        results[index] = value
+      else:
+        missing.append(index)
+    if not missing:
+      return results
+
+    remote_calls = [calls[i] for i in missing]
+    check_version = self.is_cacheable(host.get_version) and not self.is_validated()
+    if check_version:
+      remote_calls.insert(0, (host.get_version, (), {}))
+    remote_results = remote.call_many(remote_calls)
+    if check_version:
+      self.put(host.get_version, (), {}, remote_results.pop(0))
+      remote_calls.pop(0)
+
+    for index, (func, args, kwargs), value in zip(missing, remote_calls, remote_results):
+      self.put(func, args, kwargs, value)
+      results[index] = value
+    self.save()
+    return results
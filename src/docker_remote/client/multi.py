@@ -0,0 +1,257 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Runs `docker-remote compose` for many projects at once. The projects are
+discovered in a directory tree or listed in a manifest file, grouped by
+their host and run by a bounded pool of workers. All projects of a host
+share one agent (see #agent), thus the connection to every host is only
+set up once.
+
+#run_on_hosts() runs a function with one #client.Client per host of the
+`remotes` inventory (see #client.select_remotes()) in parallel.
+
+A manifest is a YAML file that lists the project directories relative to
+the manifest:
+
+```yaml
+projects:
+  - web
+  - services/db
+```
+"""
+
+import collections
+import contextlib
+import copy
+import os
+import subprocess
+import sys
+import threading
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import agent, log, placement, rendercache
+from .. import client, config
+
+#: The name of the compose file in a project directory.
+COMPOSE_FILENAME = 'docker-compose.yml'
+
+Project = collections.namedtuple('Project', 'directory name host user config')
+
+
+@contextlib.contextmanager
+def using_config(data):
+  """
+  Temporarily replaces the global configuration with *data*. Must not be
+  used while other threads access the configuration.
+  """
+
+  old_data = config.data
+  config.data = data
+  try:
+    yield
+  finally:
+    config.data = old_data
+
+
+def find_project_dirs(path):
+  """
+  Returns the project directories for *path*, which is either a directory
+  that is searched for `docker-compose.yml` files or a manifest file.
+  Hidden directories are skipped.
+  """
+
+  if os.path.isfile(path):
+    with open(path) as fp:
+      manifest = yaml.safe_load(fp) or {}
+    parent = os.path.dirname(os.path.abspath(path))
+    return [os.path.join(parent, x) for x in manifest.get('projects', [])]
+  result = []
+  for root, dirs, files in os.walk(path):
+    dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+    if COMPOSE_FILENAME in files:
+      result.append(os.path.abspath(root))
+  return result
+
+
+def load_project(directory, host=None, placers=None, name=None):
+  """
+  Reads the configuration of the project in *directory* and returns a
+  #Project. If *host* is specified, it overrides the host of the project,
+  and so does *name* for the project name.
+  Otherwise, the project is placed if the `placement.hosts` option is set
+  (see #placement). Pass the same *placers* dictionary for all projects of
+  a run, so that the hosts are polled once and the projects are spread
+  over them (see #placement.Placer).
+  """
+
+  filename = os.path.join(directory, COMPOSE_FILENAME)
+  data, _ = rendercache.load_compose_file(filename,
+    os.path.join(directory, rendercache.CACHE_DIR))
+  project_config = config.merge(copy.deepcopy(config.data),
+    copy.deepcopy(data.get('x-docker-remote', {})))
+  with using_config(project_config):
+    if host:
+      client.set_remote_config(host)
+    if name:
+      config.set('project.name', name)
+    name = config.get('project.name', None)
+    if not name:
+      raise ValueError('missing project name in {!r}'.format(filename))
+    placement_hosts = config.get('placement.hosts', None)
+    if not host and placement_hosts:
+      placed = placement.get_placement(name, directory)
+      if not placed:
+        placers = {} if placers is None else placers
+        placer = placers.setdefault(str(placement_hosts), placement.Placer(placement_hosts))
+        placed = placer.place(name, directory)
+      client.set_remote_config(placed)
+    host, user = client.get_remote_config()
+  return Project(directory, name, host, user, project_config)
+
+
+def get_host_string(host, user):
+  return '{}@{}'.format(user, host) if user else host
+
+
+def run_on_hosts(remotes, func, jobs=None):
+  """
+  Calls *func* with a #client.Client for every `(name, host, user)` tuple
+  in *remotes*, all hosts at the same time unless *jobs* limits the
+  number of threads. Returns a list of `(name, result, exception)`
+  tuples in the order of *remotes*.
+  """
+
+  def worker(host, user):
+    with client.Client(host, user, create_tunnel=False) as cl:
+      return func(cl)
+
+  results = []
+  with ThreadPoolExecutor(jobs or max(1, len(remotes))) as executor:
+    futures = [executor.submit(worker, host, user) for _, host, user in remotes]
+    for (name, _, _), future in zip(remotes, futures):
+      try:
+        results.append((name, future.result(), None))
+      except Exception as exc:
+        results.append((name, None, exc))
+  return results
+
+
+def format_table(header, rows):
+  """
+  Formats *rows* as a table with left-aligned columns.
+  """
+
+  rows = [list(map(str, header))] + [list(map(str, x)) for x in rows]
+  widths = [max(len(x[i]) for x in rows) for i in range(len(header))]
+  return '\n'.join('  '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip()
+                   for row in rows)
+
+
+def group_by_host(projects):
+  """
+  Returns an ordered dictionary that maps `(host, user)` tuples to the
+  projects on that host.
+  """
+
+  groups = collections.OrderedDict()
+  for project in sorted(projects, key=lambda x: (x.host, x.user or '', x.name)):
+    groups.setdefault((project.host, project.user), []).append(project)
+  return groups
+
+
+class ProjectRunner:
+  """
+  Runs a `docker-remote` command for every project in a subprocess and
+  prefixes every line of output with the label of the project, which is
+  its name unless *with_host* is #True. At most *jobs* subprocesses run at
+  the same time.
+  """
+
+  def __init__(self, projects, jobs=4, use_agent=True, with_host=False):
+    self.projects = list(projects)
+    self.jobs = max(1, jobs)
+    self.use_agent = use_agent and agent.is_supported()
+    self.with_host = with_host
+    self._output_lock = threading.Lock()
+    self._prefix_width = max([len(self.label(x)) for x in self.projects] or [0])
+
+  def label(self, project):
+    if self.with_host:
+      return '{} ({})'.format(project.name, get_host_string(project.host, project.user))
+    return project.name
+
+  def start_agents(self):
+    """
+    Starts the agents for all hosts and returns a dictionary that maps
+    `(host, user)` tuples to the agent socket paths. A host that fails to
+    start an agent connects on its own.
+    """
+
+    agents = {}
+    for (host, user), projects in group_by_host(self.projects).items():
+      if host == 'localhost' and not user:
+        continue
+      with using_config(projects[0].config):
+        try:
+          agents[(host, user)] = agent.start_agent(host, user)
+        except RuntimeError as exc:
+          log.warn('{}: {}'.format(client.get_remote_string(), exc))
+    return agents
+
+  def _print(self, project, line):
+    prefix = self.label(project).ljust(self._prefix_width)
+    with self._output_lock:
+      sys.stdout.write('{} | {}\n'.format(prefix, line))
+      sys.stdout.flush()
+
+  def _run(self, project, command, agent_path):
+    env = os.environ.copy()
+    if agent_path:
+      env[agent.AGENT_VAR] = agent_path
+    proc = subprocess.Popen(command, cwd=project.directory, env=env,
+      stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with proc.stdout:
+      for line in iter(proc.stdout.readline, b''):
+        self._print(project, line.decode('utf8', 'replace').rstrip('\r\n'))
+    code = proc.wait()
+    if code != 0:
+      self._print(project, 'exited with {}'.format(code))
+    return code
+
+  def run(self, argv):
+    """
+    Runs `docker-remote -H <host> <argv>` in every project directory, where
+    `<host>` is the host of the project. Returns a list
+    of `(project, exit code)` tuples in the order of #group_by_host().
+    """
+
+    agents = self.start_agents() if self.use_agent else {}
+    projects = [x for group in group_by_host(self.projects).values() for x in group]
+    with ThreadPoolExecutor(self.jobs) as executor:
+      futures = []
+      for project in projects:
+        host_string = get_host_string(project.host, project.user)
+        command = [sys.executable, '-m', 'docker_remote', '-H', host_string] + list(argv)
+        agent_path = agents.get((project.host, project.user))
+        futures.append(executor.submit(self._run, project, command, agent_path))
+      return [(project, future.result()) for project, future in zip(projects, futures)]
@@ -0,0 +1,149 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Places new projects on the least loaded of a set of candidate hosts. The
+candidates are selected from the `remotes` inventory with the
+`placement.hosts` option. The chosen host is recorded in
+`.docker-remote/placement.yml` next to the compose file, thus later
+commands go to the same host.
+"""
+
+import collections
+import os
+import yaml
+
+from . import log, multi
+from .. import client, config, host
+
+#: The file that records the host of every project, relative to the
+#: project directory.
+PLACEMENT_FILE = os.path.join('.docker-remote', 'placement.yml')
+
+
+def _load(directory):
+  try:
+    with open(os.path.join(directory, PLACEMENT_FILE)) as fp:
+      return yaml.safe_load(fp) or {}
+  except FileNotFoundError:
+    return {}
+
+
+def get_placement(project_name, directory='.'):
+  """
+  Returns the host string that *project_name* was placed on, or #None.
+  """
+
+  return _load(directory).get(project_name)
+
+
+def set_placement(project_name, host_string, directory='.'):
+  data = _load(directory)
+  data[project_name] = host_string
+  filename = os.path.join(directory, PLACEMENT_FILE)
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  with open(filename, 'w') as fp:
+    yaml.safe_dump(data, fp, default_flow_style=False)
+
+
+def get_score(stats):
+  """
+  Returns the load score for the #host.stats.get_host_stats() of a host.
+  Lower is better. The score is the load average per CPU plus the fraction
+  of used memory. Returns #None if the host has less free disk space than
+  the `placement.min_disk_free` option (in MiB, defaults to 1024).
+  """
+
+  min_disk_free = config.get('placement.min_disk_free', 1024) * 1024 * 1024
+  if stats['disk_free'] < min_disk_free:
+    return None
+  score = 0.0
+  if stats['load_average']:
+    score += stats['load_average'][0] / (stats['cpu_count'] or 1)
+  if stats['memory_total']:
+    score += 1.0 - stats['memory_available'] / stats['memory_total']
+  return score
+
+
+class Placer:
+  """
+  Places projects on the hosts selected with *selector* (see
+  #client.select_remotes()). The hosts are polled in parallel on the first
+  placement only. Every project that is placed counts toward the score of
+  its host with the `placement.project_score` option (defaults to `0.25`),
+  thus the projects of a single run are spread over the hosts although
+  none of them is deployed yet.
+  """
+
+  def __init__(self, selector):
+    self.selector = selector
+    self._hosts = None
+    self._placed = collections.Counter()
+
+  def _poll(self):
+    def probe(cl):
+      return cl.call_many([(host.stats.get_host_stats,), (host.projects.list_projects,)])
+
+    remotes = client.select_remotes(self.selector)
+    self._hosts = collections.OrderedDict()
+    for (name, h, u), (_, result, exc) in zip(remotes, multi.run_on_hosts(remotes, probe)):
+      if exc is not None:
+        log.warn('Placement: {} failed: {}'.format(name, exc))
+        continue
+      stats, projects = result
+      score = get_score(stats)
+      log.info('Placement: {} score={} containers={}'.format(name, score, stats['containers']))
+      self._hosts[name] = {'host_string': multi.get_host_string(h, u), 'score': score,
+        'containers': stats['containers'] or 0, 'projects': set(projects)}
+
+  def place(self, project_name, directory='.'):
+    """
+    Records the least loaded host for *project_name*. If the project
+    already exists on one of the hosts, that host is chosen instead.
+    Returns the host string.
+    """
+
+    if self._hosts is None:
+      self._poll()
+    project_score = config.get('placement.project_score', 0.25)
+    existing = next((k for k, v in self._hosts.items() if project_name in v['projects']), None)
+    candidates = [(v['score'] + self._placed[k] * project_score,
+                   v['containers'] + self._placed[k], k)
+                  for k, v in self._hosts.items() if v['score'] is not None]
+    if existing is not None:
+      chosen = existing
+      log.info('Project {!r} already exists on {}.'.format(project_name, chosen))
+    elif candidates:
+      chosen = min(candidates)[2]
+      self._placed[chosen] += 1
+    else:
+      raise RuntimeError('no host available to place project {!r}'.format(project_name))
+    host_string = self._hosts[chosen]['host_string']
+    log.info('Placing project {!r} on {}.'.format(project_name, host_string))
+    set_placement(project_name, host_string, directory)
+    return host_string
+
+
+def place_project(project_name, selector, directory='.'):
+  """
+  Places a single project with a new #Placer. Returns the host string.
+  """
+
+  return Placer(selector).place(project_name, directory)
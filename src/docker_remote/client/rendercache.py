@@ -0,0 +1,167 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+A local cache for parsed and rendered docker-compose files. Entries are
+stored in `.docker-remote/cache` next to the compose file and are keyed by
+the hash of the compose file, the configuration and the host, thus any
+change to one of them causes a new render.
+"""
+
+import hashlib
+import json
+import os
+import yaml
+
+from . import log
+from .. import __version__, config
+
+#: The directory that contains the cache files, relative to the working
+#: directory.
+CACHE_DIR = os.path.join('.docker-remote', 'cache')
+
+#: The number of rendered files to keep.
+MAX_ENTRIES = 16
+
+# Prefer the libyaml bindings if they are available.
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
+
+def dump_yaml(data):
+  return yaml.dump(data, Dumper=Dumper)
+
+
+def _write_file(filename, data):
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  tmpfile = '{}.{}'.format(filename, os.getpid())
+  with open(tmpfile, 'w') as fp:
+    fp.write(data)
+  os.replace(tmpfile, filename)
+
+
+def _has_str_keys(data):
+  # JSON turns other keys into strings, like `{1: 2}` or the YAML 1.1
+  # boolean in `on:`, thus such data would not survive the cache.
+  if isinstance(data, dict):
+    return all(isinstance(k, str) and _has_str_keys(v) for k, v in data.items())
+  if isinstance(data, list):
+    return all(_has_str_keys(x) for x in data)
+  return True
+
+
+def load_compose_file(filename, directory=CACHE_DIR):
+  """
+  Loads a docker-compose file. Returns the parsed data and the hash of the
+  file contents. The parsed data is cached as JSON, which is much faster to
+  load than YAML, unless it can not be represented in JSON as it is.
+  """
+
+  with open(filename, 'rb') as fp:
+    content = fp.read()
+  digest = hashlib.sha256(content).hexdigest()
+  parsed_filename = os.path.join(directory, digest + '.json')
+  try:
+    with open(parsed_filename) as fp:
+      return json.load(fp), digest
+  except (OSError, ValueError):
+    pass
+  data = yaml.load(content, Loader=SafeLoader)
+  if not _has_str_keys(data):
+    return data, digest
+  try:
+    _write_file(parsed_filename, json.dumps(data))
+  except (TypeError, ValueError):
+    pass  # Contains values that can not be represented in JSON.
+  except OSError as exc:
+    log.debug('Unable to cache parsed compose file: %s', exc)
+  return data, digest
+
+
+class RenderCache:
+  """
+  Caches rendered docker-compose files. An entry contains the rendered YAML
+  in a file that can be passed to docker-compose directly, plus the data
+  needed to prepare the project on the host again.
+  """
+
+  def __init__(self, directory=CACHE_DIR):
+    self.directory = directory
+
+  def get_key(self, file_hash, host_string):
+    hasher = hashlib.sha256()
+    hasher.update(file_hash.encode('utf8') + b'\0')
+    hasher.update(host_string.encode('utf8') + b'\0')
+    hasher.update(__version__.encode('utf8') + b'\0')
+    hasher.update(json.dumps(config.data, sort_keys=True, default=str).encode('utf8'))
+    return hasher.hexdigest()
+
+  def compose_filename(self, key):
+    return os.path.abspath(os.path.join(self.directory, key + '.rendered.yml'))
+
+  def get(self, key):
+    """
+    Returns the cached entry for *key*, or #None. The entry is a dictionary
+    with the keys `filename`, `yaml`, `volume_dirs` and `docker_host_ip`.
+    """
+
+    filename = self.compose_filename(key)
+    try:
+      with open(filename[:-len('.yml')] + '.json') as fp:
+        entry = json.load(fp)
+      with open(filename) as fp:
+        entry['yaml'] = fp.read()
+    except (OSError, ValueError):
+      return None
+    entry['filename'] = filename
+    return entry
+
+  def put(self, key, compose_yaml, volume_dirs, docker_host_ip):
+    """
+    Stores a rendered compose file and returns the cached entry.
+    """
+
+    filename = self.compose_filename(key)
+    entry = {'volume_dirs': volume_dirs, 'docker_host_ip': docker_host_ip}
+    try:
+      _write_file(filename, compose_yaml)
+      _write_file(filename[:-len('.yml')] + '.json', json.dumps(entry))
+      self.prune()
+    except OSError as exc:
+      log.debug('Unable to cache rendered compose file: %s', exc)
+      return None
+    entry.update({'filename': filename, 'yaml': compose_yaml})
+    return entry
+
+  def prune(self, max_entries=MAX_ENTRIES):
+    """
+    Removes all but the *max_entries* most recently rendered files.
+    """
+
+    files = [os.path.join(self.directory, x) for x in os.listdir(self.directory)]
+    files.sort(key=os.path.getmtime, reverse=True)
+    rendered = [x for x in files if x.endswith('.rendered.yml')]
+    parsed = [x for x in files if x.endswith('.json') and not x.endswith('.rendered.json')]
+    for filename in rendered[max_entries:]:
+      for path in (filename, filename[:-len('.yml')] + '.json'):
+        if os.path.isfile(path):
+          os.remove(path)
+    for filename in parsed[max_entries:]:
+      os.remove(filename)
@@ -0,0 +1,353 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Downloads directories from the host as a compressed `tar` stream.
+
+For an incremental download, the host describes the directory with
+#host.sync.get_manifest(), and only the files that are new or differ from
+the local copy are transferred. Files that were downloaded completely keep
+the modification time of the host, thus an interrupted download continues
+with the missing files when it is run again.
+"""
+
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import log
+from .. import client, host
+from ..core.subprocess import shell_convert, shell_popen
+
+#: The compress and decompress commands for the tar stream.
+COMPRESSORS = {
+  'none': None,
+  'gzip': (['gzip', '-c'], ['gzip', '-dc']),
+  'xz': (['xz', '-c', '-T0'], ['xz', '-dc']),
+  'zstd': (['zstd', '-c', '-q', '-T0'], ['zstd', '-dc', '-q']),
+}
+
+#: The range of the compression levels of the #COMPRESSORS.
+LEVELS = {
+  'gzip': (1, 9),
+  'xz': (0, 9),
+  'zstd': (0, 19),
+}
+
+CHUNK_SIZE = 256 * 1024
+
+
+def compare_manifest(manifest, directory):
+  """
+  Compares the *manifest* of the host with the local *directory*. Returns
+  a tuple of the relative paths that need to be downloaded and the
+  relative paths of the local files that do not exist on the host.
+
+  Local files with the same size but a different modification time are
+  hashed, and if their content matches, only the modification time is
+  updated.
+  """
+
+  changed = []
+  for relpath, (size, mtime, digest) in sorted(manifest.items()):
+    filename = os.path.join(directory, *relpath.split('/'))
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      changed.append(relpath)
+      continue
+    if st.st_size != size:
+      changed.append(relpath)
+    elif int(st.st_mtime) != mtime:
+      if host.sync.hash_file(filename) == digest:
+        os.utime(filename, (st.st_atime, mtime))
+      else:
+        changed.append(relpath)
+
+  deleted = []
+  for root, dirs, files in os.walk(directory):
+    for name in files:
+      relpath = os.path.relpath(os.path.join(root, name), directory)
+      relpath = relpath.replace(os.sep, '/')
+      if relpath not in manifest:
+        deleted.append(relpath)
+  return changed, sorted(deleted)
+
+
+def compare_local(manifest, directory):
+  """
+  The counterpart of #compare_manifest() for uploads. Returns a tuple of
+  the relative paths of the local files in *directory* that are new or
+  differ from the *manifest* of the host, and the relative paths in the
+  *manifest* that do not exist locally.
+  """
+
+  changed = []
+  found = set()
+  for root, dirs, files in os.walk(directory):
+    for name in files:
+      filename = os.path.join(root, name)
+      if os.path.islink(filename) or not os.path.isfile(filename):
+        continue
+      relpath = os.path.relpath(filename, directory).replace(os.sep, '/')
+      found.add(relpath)
+      entry = manifest.get(relpath)
+      st = os.stat(filename)
+      if entry is None or entry[0] != st.st_size:
+        changed.append(relpath)
+      elif entry[1] != int(st.st_mtime) and entry[2] != host.sync.hash_file(filename):
+        changed.append(relpath)
+  deleted = [x for x in manifest if x not in found]
+  return sorted(changed), sorted(deleted)
+
+
+def get_compression(cl, name, level=None):
+  """
+  Returns the name of the compression to use for *name*, which must be a
+  key of #COMPRESSORS. `zstd` falls back to `gzip` if it is not
+  available locally or on the host of the #client.Client *cl*. Raises a
+  #ValueError if the *level* is not supported by the compression.
+  """
+
+  if name not in COMPRESSORS:
+    raise ValueError('unknown compression {!r}'.format(name))
+  if name == 'zstd' and not (shutil.which('zstd') and
+                             cl.remote.call(host.sync.has_command, 'zstd')):
+    log.warn('zstd is not available, using gzip.')
+    name = 'gzip'
+  if level is not None and name in LEVELS:
+    low, high = LEVELS[name]
+    if not low <= level <= high:
+      raise ValueError('{} supports compression levels {} to {}, got {}'.format(
+        name, low, high, level))
+  return name
+
+
+def _is_local():
+  remote_host, user = client.get_remote_config()
+  return remote_host == 'localhost' and not user
+
+
+def _pack_commands(source_dir, dest_dir, files, compression, level, verbose):
+  # Returns the commands that create and extract the tar stream.
+  command1 = ['tar', '-cC', source_dir, '-f', '-']
+  command1 += ['--null', '-T', '-'] if files is not None else ['.']
+  command2 = ['tar', '-vxC' if verbose else '-xC', dest_dir, '-f', '-']
+  pack_cmd, unpack_cmd = shell_convert(command1), shell_convert(command2)
+  if COMPRESSORS[compression]:
+    compress, decompress = COMPRESSORS[compression]
+    if level is not None:
+      compress = compress + ['-{}'.format(level)]
+    pack_cmd += ' | ' + shell_convert(compress)
+    unpack_cmd = shell_convert(decompress) + ' | ' + unpack_cmd
+  return pack_cmd, unpack_cmd
+
+
+def _transfer(pack_cmd, unpack_cmd, files, label, compression):
+  # Pipes the tar stream from *pack_cmd* to *unpack_cmd* through this
+  # process to measure the throughput.
+  log.info('$ ' + pack_cmd + ' | ' + unpack_cmd)
+  proc1 = shell_popen(pack_cmd, stdout=subprocess.PIPE,
+    stdin=subprocess.PIPE if files is not None else subprocess.DEVNULL)
+  proc2 = shell_popen(unpack_cmd, stdin=subprocess.PIPE)
+  if files is not None:
+    # Written by a thread, the stream starts before the whole list is read.
+    def write_files():
+      with proc1.stdin:
+        proc1.stdin.write(b''.join(x.encode('utf8') + b'\0' for x in files))
+    writer = threading.Thread(target=write_files)
+    writer.start()
+
+  start = time.perf_counter()
+  transferred = 0
+  with proc1.stdout, proc2.stdin:
+    for chunk in iter(lambda: proc1.stdout.read(CHUNK_SIZE), b''):
+      transferred += len(chunk)
+      try:
+        proc2.stdin.write(chunk)
+      except BrokenPipeError:
+        break
+  code = proc1.wait() or proc2.wait()
+  proc2.wait()
+  if files is not None:
+    writer.join()
+  elapsed = max(time.perf_counter() - start, 1e-6)
+  if code == 0:
+    print('{}: {:.1f} MB in {:.1f}s, {:.1f} MB/s ({})'.format(label,
+      transferred / 1e6, elapsed, transferred / 1e6 / elapsed, compression))
+  return code
+
+
+def download(source_dir, dest_dir, files=None, compression='gzip', level=None,
+             verbose=False):
+  """
+  Downloads the directory *source_dir* from the host to *dest_dir*, or only
+  the *files* in it (paths relative to *source_dir*). The tar stream is
+  compressed with one of the #COMPRESSORS at the optional *level*. Prints
+  the throughput of the stream and returns the exit code.
+  """
+
+  pack_cmd, unpack_cmd = _pack_commands(source_dir, dest_dir, files,
+    compression, level, verbose)
+  if not _is_local():
+    pack_cmd = shell_convert(client.get_ssh_command(pack_cmd))
+  os.makedirs(dest_dir, exist_ok=True)
+  return _transfer(pack_cmd, unpack_cmd, files, dest_dir, compression)
+
+
+def upload(source_dir, dest_dir, files=None, compression='gzip', level=None):
+  """
+  The counterpart of #download() that uploads the local directory
+  *source_dir* to the directory *dest_dir* on the host, which must exist.
+  """
+
+  pack_cmd, unpack_cmd = _pack_commands(source_dir, dest_dir, files,
+    compression, level, False)
+  if not _is_local():
+    unpack_cmd = shell_convert(client.get_ssh_command(unpack_cmd))
+  return _transfer(pack_cmd, unpack_cmd, files, source_dir, compression)
+
+
+def sync_directory(source_dir, dest_dir, manifest, delete=False,
+                   compression='gzip', level=None):
+  """
+  Makes *dest_dir* a copy of the directory *source_dir* on the host,
+  downloading only new and changed files according to the *manifest* of
+  *source_dir*. If *delete* is #True, local files that do not exist on
+  the host are removed. See #download() for *compression* and *level*.
+  Returns the exit code of the transfer.
+  """
+
+  os.makedirs(dest_dir, exist_ok=True)
+  changed, deleted = compare_manifest(manifest, dest_dir)
+  size = sum(manifest[x][0] for x in changed)
+  print('{}: {} of {} files changed ({} bytes).'.format(
+    dest_dir, len(changed), len(manifest), size))
+
+  code = 0
+  if changed:
+    code = download(source_dir, dest_dir, changed, compression, level)
+  if delete and code == 0:
+    for relpath in deleted:
+      log.info('Deleting "{}".'.format(relpath))
+      os.remove(os.path.join(dest_dir, *relpath.split('/')))
+  elif deleted:
+    log.info('{} local files do not exist on the host (use --delete).'.format(len(deleted)))
+  return code
+
+
+def get_relative_volumes(compose_config):
+  """
+  Returns the local paths of the relative bind mount sources in the
+  *compose_config*, like `data` for `./data:/data`. These are the volumes
+  that are placed in the project directory on the host.
+  """
+
+  if compose_config.get('version'):
+    services = compose_config.get('services', {})
+  else:
+    services = compose_config
+  result = []
+  for service in services.values():
+    for volume in service.get('volumes', []):
+      if isinstance(volume, dict):
+        source = volume.get('source', '')
+      else:
+        source = str(volume).partition(':')[0]
+      if os.path.isabs(source) or source.startswith('~') or '/' not in source:
+        continue
+      path = os.path.normpath(source)
+      if path not in result:
+        result.append(path)
+  return result
+
+
+def push_volumes(cl, project_name, volumes, delete=False, compression='gzip',
+                 level=None, jobs=4, blob_threshold=None):
+  """
+  Uploads the local *volumes* (see #get_relative_volumes()) to the project
+  directory on the host, sending only new and changed files. If *delete*
+  is #True, files on the host that do not exist locally are removed.
+  Returns the exit code.
+
+  Changed files of at least *blob_threshold* bytes go through the blob
+  store on the host (see #client.Client.upload_blobs()), thus a file whose
+  content the host already has is not transferred again. The other files
+  are sent in one tar stream per volume.
+  """
+
+  for path in volumes:
+    if not os.path.isdir(path):
+      log.info('Skipping volume "{}", it is not a local directory.'.format(path))
+  volumes = [x for x in volumes if os.path.isdir(x)]
+  if not volumes:
+    return 0
+
+  # With the leading ./, the paths are resolved like relative volumes.
+  sources = ['./' + x.replace(os.sep, '/') for x in volumes]
+  info = cl.remote.call(host.projects.prepare_project, project_name, sources,
+    create_project=True, create_volumedirs=True)
+  remote_dirs = info['volumes']
+  remote_path = __import__(info['path_module'], fromlist=[None])
+  manifests = cl.get_manifests(remote_dirs)
+  compression = get_compression(cl, compression, level)
+
+  changes = [compare_local(m, v) for m, v in zip(manifests, volumes)]
+  blobs = []
+  for index, (changed, _) in enumerate(changes):
+    sizes = [os.path.getsize(os.path.join(volumes[index], x)) for x in changed]
+    print('{}: {} files changed ({} bytes).'.format(volumes[index], len(changed), sum(sizes)))
+    if blob_threshold is not None:
+      blobs += [(index, x) for x, size in zip(changed, sizes) if size >= blob_threshold]
+
+  # The large files of all volumes in one pass, before the remotepy session
+  # is left to the tar streams.
+  if blobs:
+    filenames = [os.path.join(volumes[i], *x.split('/')) for i, x in blobs]
+    digests = cl.upload_blobs(filenames)
+    items = []
+    for (index, relpath), filename, digest in zip(blobs, filenames, digests):
+      st = os.stat(filename)
+      items.append((digest, remote_path.join(remote_dirs[index], *relpath.split('/')),
+        st.st_mode & 0o777, int(st.st_mtime)))
+    cl.remote.call(host.blobs.copy_blobs, items)
+  blobs = set(blobs)
+
+  def push(index):
+    changed = [x for x in changes[index][0] if (index, x) not in blobs]
+    if not changed:
+      return 0
+    return upload(volumes[index], remote_dirs[index], changed, compression, level)
+
+  with ThreadPoolExecutor(max(1, jobs)) as executor:
+    codes = list(executor.map(push, range(len(volumes))))
+
+  code = next((x for x in codes if x != 0), 0)
+  removals = [(host.sync.remove_files, (remote_dirs[i], deleted))
+              for i, (_, deleted) in enumerate(changes) if deleted]
+  if delete and code == 0 and removals:
+    cl.remote.call_many(removals)
+  elif removals:
+    log.info('Files on the host that do not exist locally are kept (use --delete).')
+  return code
@@ -0,0 +1,366 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Asyncio clients for the remotepy protocol. They always use the multiplexed
+protocol, thus many calls can be in flight over the same session and a
+single event loop can drive many hosts without a thread per connection.
+
+```python
+async with AsyncSSHClient('myhost', 'root') as client:
+  projects = await client.call(host.projects.list_projects)
+```
+"""
+
+import asyncio
+import io
+import itertools
+
+from . import bootstrap
+from .remotepy import (TOOL_NAME, V2_HEADER, NegotiatedCodec, PickleCodec,
+  hello_request, ioproto_args, unpack_response, write_frame, _normalize_call)
+
+
+class AsyncIoProtocolClient:
+  """
+  Client for the #MultiplexIoProtocolHandler on top of asyncio streams.
+  Responses are read by a background task and dispatched to the waiting
+  callers by their request ID. See #IoProtocolClient for *negotiate*.
+  """
+
+  def __init__(self, reader, writer, negotiate=None, stream_buffer=64):
+    self.reader = reader
+    self.writer = writer
+    self.stream_buffer = stream_buffer
+    self.codec = PickleCodec()
+    self._negotiate = negotiate
+    self._handshake_lock = asyncio.Lock()
+    self._request_ids = itertools.count()
+    self._pending = {}
+    self._streams = {}
+    self._closed = False
+    self._reader_task = asyncio.ensure_future(self._read_responses())
+
+  async def _read_responses(self):
+    try:
+      while True:
+        header = await self.reader.readexactly(V2_HEADER.size)
+        response_size, request_id = V2_HEADER.unpack(header)
+        data = await self.reader.readexactly(response_size)
+        try:
+          response = self.codec.decode(self.codec.receive(io.BytesIO(data), response_size))
+        except Exception as exc:
+          response = ('exception', exc)
+        stream = self._streams.get(request_id)
+        if stream is not None:
+          if response[0] != 'yield':
+            del self._streams[request_id]
+          # Never waits, the handler does not send more items than the
+          # stream granted credit for.
+          stream.put_nowait(response)
+          continue
+        future = self._pending.pop(request_id, None)
+        if future is None or future.done():
+          continue
+        if response[0] == 'generator':
+          stream = AsyncRemoteIterator(self, request_id, self.stream_buffer)
+          self._streams[request_id] = stream
+          future.set_result(stream)
+          continue
+        try:
+          future.set_result(unpack_response(response))
+        except BaseException as exc:
+          future.set_exception(exc)
+    except (asyncio.IncompleteReadError, OSError):
+      pass  # The stream has been closed.
+    finally:
+      self._closed = True
+      pending, self._pending = self._pending, {}
+      for future in pending.values():
+        if not future.done():
+          future.set_exception(EOFError('remotepy connection closed'))
+      for stream in self._streams.values():
+        stream.put_nowait(('exception', EOFError('remotepy connection closed')))
+      self._streams.clear()
+
+  async def _send(self, request):
+    if self._closed:
+      raise EOFError('remotepy connection closed')
+    future = asyncio.get_event_loop().create_future()
+    request_id = next(self._request_ids) & 0xffffffff
+    self._pending[request_id] = future
+    write_frame(self.writer, self.codec.encode(request), request_id)
+    await self.writer.drain()
+    return future
+
+  def _send_control(self, request_id, message):
+    # Sends a flow control frame for the stream with the *request_id*. The
+    # frames are small, thus the writer is not drained.
+    if not self._closed:
+      write_frame(self.writer, self.codec.encode(message), request_id)
+
+  async def _handshake(self):
+    async with self._handshake_lock:
+      if self._negotiate is None:
+        return
+      # Other calls wait for the lock until the handshake is complete.
+      try:
+        future = await self._send({'hello': hello_request(**self._negotiate)})
+        settings = await future
+      except KeyError:
+        return  # The handler does not support the handshake.
+      finally:
+        self._negotiate = None
+      self.codec = NegotiatedCodec(**settings)
+
+  async def submit(self, __func, *args, **kwargs):
+    """
+    Sends a request and returns an #asyncio.Future for the result.
+    """
+
+    if self._negotiate is not None:
+      await self._handshake()
+    return await self._send({'function': __func, 'args': args, 'kwargs': kwargs,
+                             'window': self.stream_buffer})
+
+  async def call(self, __func, *args, **kwargs):
+    """
+    Calls *__func* on the remote and returns its return value. If the
+    function returns a generator, an #AsyncRemoteIterator is returned, which
+    should be consumed or closed with #AsyncRemoteIterator.aclose().
+    """
+
+    return await (await self.submit(__func, *args, **kwargs))
+
+  async def call_many(self, calls, return_exceptions=False):
+    """
+    Like #IoProtocolClient.call_many(), but the calls are executed
+    concurrently on the remote.
+    """
+
+    futures = [await self.submit(func, *args, **kwargs)
+               for func, args, kwargs in map(_normalize_call, calls)]
+    return list(await asyncio.gather(*futures, return_exceptions=return_exceptions))
+
+  async def aclose(self):
+    self.writer.close()
+    await self._reader_task
+
+
+class AsyncRemoteIterator:
+  """
+  The asynchronous counterpart of the #RemoteIterator. The handler sends at
+  most *window* items ahead of the consumer, as the consumed items are
+  credited back in batches (see #StreamWindow). Use #aclose() or an
+  `async with` block to discard the remaining items.
+  """
+
+  def __init__(self, client, request_id, window):
+    self._queue = asyncio.Queue()
+    self._client = client
+    self._request_id = request_id
+    self._batch = max(1, window // 2)
+    self._consumed = 0
+    self._finished = False
+    self._discarded = False
+    self.value = None
+
+  def put_nowait(self, frame):
+    if not self._discarded:
+      self._queue.put_nowait(frame)
+
+  async def aclose(self):
+    """
+    Discards the remaining items and cancels the stream on the handler.
+    """
+
+    if not self._finished:
+      self._client._send_control(self._request_id, {'cancel': True})
+    self._finished = True
+    self._discarded = True
+    while not self._queue.empty():
+      self._queue.get_nowait()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *a):
+    await self.aclose()
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    if self._finished:
+      raise StopAsyncIteration
+    type_, data = frame = await self._queue.get()
+    if type_ == 'yield':
+      self._consumed += 1
+      if self._consumed >= self._batch:
+        self._client._send_control(self._request_id, {'credit': self._consumed})
+        self._consumed = 0
+      return data
+    self._finished = True
+    if type_ == 'return':
+      self.value = data
+      raise StopAsyncIteration
+    return unpack_response(frame)
+
+
+class _AsyncProcessClient:
+  """
+  Base class for clients that communicate with a subprocess. The standard
+  error of the process is forwarded by a background task.
+  """
+
+  read_stderr = True
+  negotiate = None
+
+  def _command(self, upload=False):
+    raise NotImplementedError
+
+  async def _start(self, upload=False):
+    command = self._command(upload)
+    stderr = asyncio.subprocess.PIPE if self.read_stderr else None
+    self._proc = await asyncio.create_subprocess_exec(*command,
+      stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+      stderr=stderr)
+    if self.read_stderr:
+      self._stderr_task = asyncio.ensure_future(self._forward_stderr(self._proc.stderr))
+    if upload:
+      self._proc.stdin.write(bootstrap.pack_sources())
+    self._client = AsyncIoProtocolClient(self._proc.stdout, self._proc.stdin,
+      self.negotiate)
+
+  async def _forward_stderr(self, stream):
+    while True:
+      line = await stream.readline()
+      if not line:
+        break
+      print('remote:', line.decode().rstrip())
+
+  async def _stop(self):
+    self._proc.stdin.close()
+    if self._proc.returncode is None:
+      try:
+        await asyncio.wait_for(self._proc.wait(), 5)
+      except asyncio.TimeoutError:
+        self._proc.terminate()
+        await self._proc.wait()
+    await self._client._reader_task
+    if self.read_stderr:
+      await self._stderr_task
+
+  async def __aenter__(self):
+    await self._start()
+    return self
+
+  async def __aexit__(self, *a):
+    await self._stop()
+
+  async def call(self, *args, **kwargs):
+    return await self._client.call(*args, **kwargs)
+
+  async def call_many(self, *args, **kwargs):
+    return await self._client.call_many(*args, **kwargs)
+
+
+class AsyncSSHClient(_AsyncProcessClient):
+  """
+  The asyncio counterpart of the #SSHClient.
+  """
+
+  def __init__(self, host, username=None, read_stderr=True, tool_name=None,
+               daemon=False, bootstrap=False, python='python3', negotiate=None,
+               ssh_options=None):
+    self.host = host
+    self.username = username
+    self.read_stderr = read_stderr
+    self.tool_name = tool_name or TOOL_NAME
+    self.daemon = daemon
+    self.bootstrap = bootstrap
+    self.python = python
+    self.negotiate = negotiate
+    self.ssh_options = list(ssh_options or [])
+    self._bootstrap_pending = False
+    self._uploaded = False
+
+  @property
+  def host_string(self):
+    if self.username:
+      return '{}@{}'.format(self.username, self.host)
+    return self.host
+
+  def _command(self, upload=False):
+    args = ioproto_args(True, self.daemon)
+    if self.bootstrap:
+      if self.daemon:
+        args += ['--socket', bootstrap.socket_path()]
+      return ['ssh'] + self.ssh_options + [self.host_string] + \
+        bootstrap.stub_command(self.python, upload, args)
+    return ['ssh'] + self.ssh_options + [self.host_string, self.tool_name] + args
+
+  async def __aenter__(self):
+    upload = False
+    if self.bootstrap:
+      upload = not bootstrap.is_cached_on(self.host_string)
+      self._bootstrap_pending = True
+    await self._start(upload)
+    self._uploaded = upload
+    return self
+
+  async def _call(self, method, *args, **kwargs):
+    if not self._bootstrap_pending:
+      return await getattr(self._client, method)(*args, **kwargs)
+    # See SSHClient._call().
+    try:
+      result = await getattr(self._client, method)(*args, **kwargs)
+    except EOFError:
+      if await self._proc.wait() != bootstrap.EXIT_MISSING:
+        raise
+      await self._stop()
+      await self._start(upload=True)
+      self._uploaded = True
+      result = await getattr(self._client, method)(*args, **kwargs)
+    self._bootstrap_pending = False
+    # Only recorded once a call succeeded, a failed upload is retried.
+    if self._uploaded:
+      bootstrap.set_cached_on(self.host_string)
+    return result
+
+  async def call(self, *args, **kwargs):
+    return await self._call('call', *args, **kwargs)
+
+  async def call_many(self, *args, **kwargs):
+    return await self._call('call_many', *args, **kwargs)
+
+
+class AsyncLocalClient(_AsyncProcessClient):
+  """
+  The asyncio counterpart of the #LocalClient.
+  """
+
+  def __init__(self, daemon=False, negotiate=None):
+    self.daemon = daemon
+    self.negotiate = negotiate
+    self.read_stderr = False
+
+  def _command(self, upload=False):
+    return [TOOL_NAME] + ioproto_args(True, self.daemon)
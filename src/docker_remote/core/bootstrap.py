@@ -0,0 +1,173 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Runs remotepy on a host that does not have docker-remote installed. A small
+stub is passed to `python3 -c` which receives the sources of the modules that
+are needed on the host over the standard input and caches them in a directory
+named after the hash of the sources. Subsequent sessions with the same
+sources skip the transfer.
+
+Note that the third-party dependencies of the host modules (PyYAML and
+nr.fs) must still be available on the host.
+"""
+
+import hashlib
+import os
+import pickle
+import shlex
+import struct
+import zlib
+
+#: The directory on the host where the sources are cached.
+CACHE_DIR = '~/.cache/docker-remote/bootstrap'
+
+#: The directory on the client that records which hosts already have the
+#: sources with a given hash.
+HOSTS_DIR = os.path.expanduser('~/.cache/docker-remote/bootstrap-hosts')
+
+#: The stub exits with this code if it was told that the sources are cached
+#: but they are not.
+EXIT_MISSING = 3
+
+#: Modules of the docker_remote package that are shipped to the host.
+MODULES = ['__init__.py', 'config.py', 'core', 'host']
+
+STUB = '''\
+import os,sys,struct,pickle,zlib,shutil
+h,m=sys.argv[1:3]
+d=os.path.join(os.path.expanduser({cache_dir!r}),h)
+if m=='upload':
+ i=sys.stdin.buffer;n=struct.unpack('!I',i.read(4))[0];f=pickle.loads(zlib.decompress(i.read(n)))
+ if not os.path.isdir(d):
+  t='%s.%d'%(d,os.getpid())
+  for k,v in f.items():
+   p=os.path.join(t,k);os.makedirs(os.path.dirname(p),exist_ok=True)
+   with open(p,'wb') as o:o.write(v)
+  try:os.rename(t,d)
+  except OSError:shutil.rmtree(t)
+elif not os.path.isdir(d):
+ sys.stderr.write('docker-remote bootstrap cache missing\\n');sys.exit({exit_missing})
+sys.path.insert(0,d)
+from docker_remote.core.remotepy import main
+main(sys.argv[3:])
+'''.format(cache_dir=CACHE_DIR, exit_missing=EXIT_MISSING)
+
+_sources = None
+_digest = None
+
+
+def get_sources():
+  """
+  Returns a dictionary that maps the paths of the source files that need to
+  be shipped to the host (relative to the package parent directory) to their
+  contents.
+  """
+
+  global _sources
+  if _sources is None:
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parent_dir = os.path.dirname(package_dir)
+    sources = {}
+    for name in MODULES:
+      path = os.path.join(package_dir, name)
+      if os.path.isfile(path):
+        files = [path]
+      else:
+        files = [os.path.join(path, x) for x in os.listdir(path) if x.endswith('.py')]
+      for filename in files:
+        with open(filename, 'rb') as fp:
+          relpath = os.path.relpath(filename, parent_dir).replace(os.sep, '/')
+          sources[relpath] = fp.read()
+    _sources = sources
+  return _sources
+
+
+def get_digest():
+  """
+  Returns the SHA256 hash of the sources returned by #get_sources().
+  """
+
+  global _digest
+  if _digest is None:
+    hasher = hashlib.sha256()
+    for relpath, data in sorted(get_sources().items()):
+      hasher.update(relpath.encode('utf8') + b'\0')
+      hasher.update(struct.pack('!Q', len(data)) + data)
+    _digest = hasher.hexdigest()
+  return _digest
+
+
+def pack_sources():
+  """
+  Returns the frame that the stub expects on its standard input when the
+  sources are uploaded.
+  """
+
+  data = zlib.compress(pickle.dumps(get_sources()))
+  return struct.pack('!I', len(data)) + data
+
+
+def stub_command(python, upload, args):
+  """
+  Returns the command to run the stub on the host. The command is supposed
+  to be passed to `ssh`, thus the stub is quoted for the remote shell.
+  """
+
+  mode = 'upload' if upload else 'cached'
+  return [python, '-c', shlex.quote(STUB), get_digest(), mode] + list(args)
+
+
+def socket_path():
+  """
+  Returns the path of the daemon socket on the host for the current sources.
+  """
+
+  return '~/.cache/docker-remote/remotepy-{}.sock'.format(get_digest()[:16])
+
+
+def _host_record(host):
+  return os.path.join(HOSTS_DIR, host.replace(os.sep, '_'))
+
+
+def is_cached_on(host):
+  """
+  Returns #True if the sources are known to be cached on *host*.
+  """
+
+  try:
+    with open(_host_record(host)) as fp:
+      return fp.read().strip() == get_digest()
+  except FileNotFoundError:
+    return False
+
+
+def set_cached_on(host, cached=True):
+  """
+  Records whether the sources are cached on *host*.
+  """
+
+  filename = _host_record(host)
+  if cached:
+    os.makedirs(HOSTS_DIR, exist_ok=True)
+    with open(filename, 'w') as fp:
+      fp.write(get_digest())
+  elif os.path.isfile(filename):
+    os.remove(filename)
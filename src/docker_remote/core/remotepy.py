@@ -27,18 +27,243 @@ value.
 from __future__ import absolute_import
 
 import argparse
+import concurrent.futures
+import collections
+import errno
+import inspect
+import io
+import itertools
+import lzma
+import os
 import pickle
+import queue
 import shlex
 import signal
+import socket
 import subprocess
 import sys
 import struct
 import threading
+import time
 import traceback
+import zlib
+from . import bootstrap
+from .. import __version__
 from .subprocess import shell_popen
 
 TOOL_NAME = 'docker-remote.core.remotepy'
 
+#: Frame header of the multiplexed protocol: payload size and request ID.
+V2_HEADER = struct.Struct('!II')
+
+#: Compression algorithms that can be negotiated for the #NegotiatedCodec.
+COMPRESSION = {
+  'zlib': (zlib.compress, zlib.decompress),
+  'lzma': (lzma.compress, lzma.decompress),
+}
+
+#: Default path of the Unix socket of the #DaemonServer on the host. It
+#: contains the version, so that an upgraded host does not keep using the
+#: daemon of the previous version.
+DEFAULT_SOCKET = '~/.cache/docker-remote/remotepy-{}.sock'.format(__version__)
+
+
+class PickleCodec:
+  """
+  Encodes the payload of a frame as a plain pickle. This is the format that
+  is used until the handshake has agreed on a #NegotiatedCodec.
+  """
+
+  def encode(self, obj):
+    """
+    Returns a list of bytes-like objects that make up the payload.
+    """
+
+    return [pickle.dumps(obj)]
+
+  def receive(self, fp, size):
+    """
+    Reads the payload of *size* bytes. The result must be passed to
+    #decode() before the next payload is received.
+    """
+
+    return fp.read(size)
+
+  def decode(self, payload):
+    return pickle.loads(payload)
+
+
+class NegotiatedCodec(PickleCodec):
+  """
+  Encodes the payload of a frame with the settings agreed on in the
+  handshake (see #negotiate_settings()). The payload starts with a flags
+  byte that describes how the rest of it is encoded:
+
+  * The pickle stream is compressed with the *compression* algorithm if it
+    is larger than *threshold* bytes (and if that makes it smaller).
+  * With pickle protocol 5, large buffers are sent out-of-band after the
+    pickle stream. This applies to #memoryview and #pickle.PickleBuffer
+    objects and to #bytes and #bytearray objects of at least *oob_threshold*
+    bytes that are passed as arguments, returned or yielded. They are not
+    compressed and the receiving end reads them directly into the
+    #bytearray objects that the unpickled data will reference.
+
+  The pickle stream is read into a buffer that is reused between frames.
+  """
+
+  FLAG_ZLIB = 1
+  FLAG_LZMA = 2
+  FLAG_OOB = 4
+
+  def __init__(self, protocol=None, compression=None, threshold=4096,
+               oob_threshold=None):
+    self.protocol = protocol
+    self.compression = compression
+    self.threshold = threshold
+    self.oob_threshold = oob_threshold
+    self._buffer = bytearray()
+
+  def encode(self, obj):
+    buffers = []
+    fp = io.BytesIO()
+    if self.oob_threshold is not None:
+      obj = _mark_out_of_band(obj, self.oob_threshold)
+      _OobPickler(fp, self.protocol, buffer_callback=buffers.append).dump(obj)
+    else:
+      pickle.Pickler(fp, self.protocol).dump(obj)
+    body = fp.getbuffer()
+
+    flags = 0
+    if self.compression and len(body) > self.threshold:
+      compressed = COMPRESSION[self.compression][0](body)
+      if len(compressed) < len(body):
+        body = compressed
+        flags |= self.FLAG_ZLIB if self.compression == 'zlib' else self.FLAG_LZMA
+
+    if not buffers:
+      return [bytes([flags]), body]
+    buffers = [x.raw() for x in buffers]
+    header = struct.pack('!BI{}Q'.format(len(buffers)), flags | self.FLAG_OOB,
+      len(buffers), *(x.nbytes for x in buffers))
+    return [header, body] + buffers
+
+  def receive(self, fp, size):
+    flags = _read_exactly(fp, 1)[0]
+    size -= 1
+    sizes = []
+    if flags & self.FLAG_OOB:
+      count = struct.unpack('!I', _read_exactly(fp, 4))[0]
+      sizes = struct.unpack('!{}Q'.format(count), _read_exactly(fp, 8 * count))
+      size -= 4 + 8 * count + sum(sizes)
+    if len(self._buffer) < size:
+      # Not resized in place as views of the old buffer may still exist.
+      self._buffer = bytearray(size)
+    body = memoryview(self._buffer)[:size]
+    _readinto_exactly(fp, body)
+    buffers = []
+    for buffer_size in sizes:
+      buffers.append(bytearray(buffer_size))
+      _readinto_exactly(fp, memoryview(buffers[-1]))
+    return flags, body, buffers
+
+  def decode(self, payload):
+    flags, body, buffers = payload
+    if flags & self.FLAG_ZLIB:
+      body = COMPRESSION['zlib'][1](body)
+    elif flags & self.FLAG_LZMA:
+      body = COMPRESSION['lzma'][1](body)
+    return pickle.loads(body, buffers=buffers)
+
+
+class _OobPickler(pickle.Pickler):
+
+  def reducer_override(self, obj):
+    if isinstance(obj, memoryview):
+      return _identity, (pickle.PickleBuffer(obj),)
+    return NotImplemented
+
+
+class _OutOfBand:
+  """
+  Wraps a #bytes or #bytearray object so that it is pickled out-of-band.
+  The pickler does not give us a hook for these types otherwise.
+  """
+
+  def __init__(self, data):
+    self.data = data
+
+  def __reduce_ex__(self, protocol):
+    factory = bytes if isinstance(self.data, bytes) else _identity
+    return factory, (pickle.PickleBuffer(self.data),)
+
+
+def _mark_out_of_band(message, threshold):
+  """
+  Wraps the large #bytes and #bytearray values of a request (arguments) or
+  response (return value or item) in #_OutOfBand objects.
+  """
+
+  def mark(value):
+    if isinstance(value, (bytes, bytearray)) and len(value) >= threshold:
+      return _OutOfBand(value)
+    return value
+
+  if isinstance(message, tuple):
+    return (message[0], mark(message[1]))
+  if isinstance(message, dict) and 'function' in message:
+    return dict(message, args=tuple(map(mark, message['args'])),
+      kwargs={k: mark(v) for k, v in message['kwargs'].items()})
+  return message
+
+
+def _identity(value):
+  return value
+
+
+def _readinto_exactly(fp, view):
+  while view:
+    count = fp.readinto(view)
+    if not count:
+      raise EOFError('unexpected end of stream')
+    view = view[count:]
+
+
+def _read_exactly(fp, size):
+  data = fp.read(size)
+  if len(data) < size:
+    raise EOFError('unexpected end of stream')
+  return data
+
+
+def negotiate_settings(hello):
+  """
+  Returns the settings for the #NegotiatedCodec from the handshake request
+  that a client sent.
+  """
+
+  protocol = min(hello.get('protocol', pickle.DEFAULT_PROTOCOL), pickle.HIGHEST_PROTOCOL)
+  compression = next((x for x in hello.get('compression', []) if x in COMPRESSION), None)
+  oob_threshold = hello.get('oob_threshold')
+  if protocol < 5:
+    oob_threshold = None
+  return {'protocol': protocol, 'compression': compression,
+    'threshold': hello.get('threshold', 4096), 'oob_threshold': oob_threshold}
+
+
+def write_frame(fp, chunks, request_id=None):
+  """
+  Writes a frame with the payload *chunks* as returned by a codec. The
+  frame header contains the *request_id* if it is not #None (v2 framing).
+  """
+
+  size = sum(memoryview(x).nbytes for x in chunks)
+  if request_id is None:
+    fp.write(struct.pack('!I', size))
+  else:
+    fp.write(V2_HEADER.pack(size, request_id))
+  for chunk in chunks:
+    fp.write(chunk)
+
 
 class IoProtocolHandler:
   """
@@ -50,30 +275,112 @@ class IoProtocolHandler:
     self.stdin = stdin or sys.stdin.buffer
     self.stdout = stdout or sys.stdout.buffer
     self.log_exception = log_exception
+    self.codec = PickleCodec()
 
-  def handle_request(self):
-    object_size = self.stdin.read(4)
-    if not object_size:
-      return False  # End of stream
+  def _encode_response(self, response):
     try:
-      object_size = struct.unpack('!I', object_size)[0]
-      data = pickle.loads(self.stdin.read(object_size))
-      response = data['function'](*data['args'], **data['kwargs'])
-      response = ('return', response)
+      return self.codec.encode(response)
     except BaseException as exc:
       if self.log_exception:
         traceback.print_exc()
-      response = ('exception', exc)
+      # This should *really* be picklable..
+      return self.codec.encode(('exception', exc))
+
+  def _read_request(self, size):
+    """
+    Reads and decodes a request. If the request can not be decoded, the
+    exception is returned instead.
+    """
+
+    payload = self.codec.receive(self.stdin, size)
+    try:
+      return self.codec.decode(payload)
+    except BaseException as exc:
+      return exc
+
+  def _call(self, request):
+    """
+    Executes the function of a request. Subclasses can override this method
+    to dispatch requests elsewhere.
+    """
+
+    return request['function'](*request['args'], **request['kwargs'])
+
+  def _process_request(self, request, window=None):
+    """
+    Executes a request. Yields the encoded response frames.
+
+    If the function returns a generator, its items are streamed as separate
+    frames: a `('generator', None)` frame is followed by one `('yield', item)`
+    frame per item and a final `('return', value)` or `('exception', exc)`
+    frame. The items are produced only as fast as they can be written. If a
+    #StreamWindow is passed as *window*, an item is only produced once the
+    client granted the credit for it.
+
+    A handshake request (see #IoProtocolClient) is answered with the
+    settings for the #NegotiatedCodec, which is used for all subsequent
+    frames.
+    """
+
     try:
-      response = pickle.dumps(response)
+      if isinstance(request, BaseException):
+        raise request
+      if 'hello' in request:
+        settings = negotiate_settings(request['hello'])
+        response = self._encode_response(('return', settings))
+        # The client does not send another request before it received the
+        # response, so it is safe to switch the codec now.
+        self.codec = NegotiatedCodec(**settings)
+      else:
+        result = self._call(request)
     except BaseException as exc:
       if self.log_exception:
         traceback.print_exc()
-      # This should *really* be picklable..
-      response = pickle.dumps(('exception', exc))
-    self.stdout.write(struct.pack('!I', len(response)))
-    self.stdout.write(response)
-    self.stdout.flush()
+      yield self._encode_response(('exception', exc))
+      return
+
+    if 'hello' in request:
+      yield response
+      return
+    if not inspect.isgenerator(result):
+      yield self._encode_response(('return', result))
+      return
+
+    yield self._encode_response(('generator', None))
+    try:
+      while True:
+        if window is not None and not window.acquire():
+          # The client closed the stream, nobody reads the remaining items.
+          result.close()
+          yield self._encode_response(('return', None))
+          return
+        yield self.codec.encode(('yield', next(result)))
+    except StopIteration as exc:
+      yield self._encode_response(('return', exc.value))
+    except GeneratorExit:
+      # The frames are no longer consumed, make sure that the generator of
+      # the remote function is finalized as well.
+      result.close()
+      raise
+    except BaseException as exc:
+      if self.log_exception:
+        traceback.print_exc()
+      result.close()
+      yield self._encode_response(('exception', exc))
+
+  def handle_request(self):
+    object_size = self.stdin.read(4)
+    if not object_size:
+      return False  # End of stream
+    object_size = struct.unpack('!I', object_size)[0]
+    responses = self._process_request(self._read_request(object_size))
+    try:
+      for response in responses:
+        write_frame(self.stdout, response)
+        self.stdout.flush()
+    finally:
+      # Stops a streamed result if the client went away.
+      responses.close()
     return True
 
   def __enter__(self):
@@ -87,51 +394,548 @@ class IoProtocolHandler:
       sys.stdin, sys.stdout = self._old_std
 
 
+class StreamWindow:
+  """
+  The credit of a streamed response in the multiplexed protocol. The
+  handler takes one credit per item that it sends and the client grants new
+  credit as it consumes the items, thus the client never has to buffer more
+  than the initial *credit* items of a stream.
+  """
+
+  def __init__(self, credit):
+    self._cond = threading.Condition()
+    self._credit = credit
+    self._cancelled = False
+
+  def grant(self, credit):
+    with self._cond:
+      self._credit += credit
+      self._cond.notify()
+
+  def cancel(self):
+    with self._cond:
+      self._cancelled = True
+      self._cond.notify()
+
+  def acquire(self):
+    """
+    Waits for a credit. Returns #False if the stream was cancelled.
+    """
+
+    with self._cond:
+      while self._credit <= 0 and not self._cancelled:
+        self._cond.wait()
+      if self._cancelled:
+        return False
+      self._credit -= 1
+      return True
+
+
+class MultiplexIoProtocolHandler(IoProtocolHandler):
+  """
+  Implements the multiplexed (v2) framing of the protocol, where every frame
+  carries a request ID in addition to its size. Requests are dispatched to a
+  thread pool and the responses are sent back as soon as they are available,
+  thus possibly out of order. A slow call does not block other calls.
+
+  A request may specify a `'window'`, in which case the items of a streamed
+  response are subject to flow control (see #StreamWindow). The client
+  grants more credit with a `{'credit': n}` frame and closes the stream
+  with a `{'cancel': True}` frame, both with the request ID of the stream.
+  """
+
+  def __init__(self, stdin=None, stdout=None, log_exception=False,
+               max_workers=None):
+    super().__init__(stdin, stdout, log_exception)
+    self.max_workers = max_workers
+    self._write_lock = threading.Lock()
+    self._windows = {}
+    self._executor = None
+
+  def _handle_frame(self, request_id, request):
+    try:
+      window = self._windows.get(request_id)
+      responses = self._process_request(request, window)
+      try:
+        for response in responses:
+          with self._write_lock:
+            write_frame(self.stdout, response, request_id)
+            self.stdout.flush()
+      finally:
+        responses.close()
+    finally:
+      self._windows.pop(request_id, None)
+
+  def handle_request(self):
+    header = self.stdin.read(V2_HEADER.size)
+    if len(header) < V2_HEADER.size:
+      # End of stream, the remaining items of the streams can not be sent.
+      for window in list(self._windows.values()):
+        window.cancel()
+      return False
+    object_size, request_id = V2_HEADER.unpack(header)
+    request = self._read_request(object_size)
+    if isinstance(request, dict) and ('credit' in request or 'cancel' in request):
+      # Flow control for a stream, handled right away as the stream waits
+      # for it in another thread.
+      window = self._windows.get(request_id)
+      if window is not None and request.get('cancel'):
+        window.cancel()
+      elif window is not None:
+        window.grant(request['credit'])
+      return True
+    if isinstance(request, dict) and request.get('window'):
+      self._windows[request_id] = StreamWindow(request['window'])
+    self._executor.submit(self._handle_frame, request_id, request)
+    return True
+
+  def __enter__(self):
+    self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+    return super().__enter__()
+
+  def __exit__(self, *a):
+    for window in list(self._windows.values()):
+      window.cancel()
+    # Wait for the requests that are still in flight.
+    self._executor.shutdown(wait=True)
+    return super().__exit__(*a)
+
+
 class IoProtocolClient:
   """
   This class enables communication with the #IoProtocolHandler backend.
+
+  If *negotiate* is a dictionary, a handshake is performed before the first
+  call to agree on the pickle protocol and compression (see
+  #hello_request() for the supported options). If the handler does not
+  support the handshake, plain pickles are used.
   """
 
-  def __init__(self, fwrite, fread):
+  def __init__(self, fwrite, fread, negotiate=None):
     self.fwrite = fwrite
     self.fread = fread
+    self.codec = PickleCodec()
+    self._negotiate = negotiate
+    self._stream = None
 
-  def call(self, __func, *args, **kwargs):
-    request = {'function': __func, 'args': args, 'kwargs': kwargs}
-    request = pickle.dumps(request)
-    self.fwrite.write(struct.pack('!I', len(request)))
-    self.fwrite.write(request)
+  def _handshake(self):
+    options, self._negotiate = self._negotiate, None
+    write_frame(self.fwrite, self.codec.encode({'hello': hello_request(**options)}))
     self.fwrite.flush()
+    try:
+      settings = self._receive()
+    except KeyError:
+      return  # The handler does not support the handshake.
+    self.codec = NegotiatedCodec(**settings)
+
+  def _drain_stream(self):
+    # The response frames of a streamed result must be read before any
+    # other response can be read.
+    if self._stream is not None:
+      self._stream.drain()
+      self._stream = None
+
+  def _send_request(self, func, args, kwargs):
+    self._drain_stream()
+    if self._negotiate is not None:
+      self._handshake()
+    request = {'function': func, 'args': args, 'kwargs': kwargs}
+    write_frame(self.fwrite, self.codec.encode(request))
+
+  def _read_response(self):
     response_size = struct.unpack('!I', self.fread.read(4))[0]
-    type_, data = pickle.loads(self.fread.read(response_size))
-    if type_ == 'return':
-      return data
-    elif type_ == 'exception':
-      raise data
+    return self.codec.decode(self.codec.receive(self.fread, response_size))
+
+  def _receive(self):
+    self._drain_stream()
+    response = self._read_response()
+    if response[0] == 'generator':
+      self._stream = RemoteIterator(self._read_response)
+      return self._stream
+    return unpack_response(response)
+
+  def call(self, __func, *args, **kwargs):
+    """
+    Calls *__func* on the remote and returns its return value. If the
+    function returns a generator, a #RemoteIterator is returned that reads
+    the items as they arrive. It should be consumed before the next call
+    is made, otherwise the remaining items are buffered in memory.
+    """
+
+    self._send_request(__func, args, kwargs)
+    self.fwrite.flush()
+    return self._receive()
+
+  def call_many(self, calls, return_exceptions=False):
+    """
+    Pipelines multiple calls to the handler. All requests are written back
+    to back before the responses are read, thus the whole batch costs only a
+    single round trip. *calls* must be an iterable of `(func, args, kwargs)`
+    tuples, where *args* and *kwargs* may be omitted.
+
+    Returns a list of the return values in the same order as *calls*. If
+    *return_exceptions* is #True, exceptions raised by the remote functions
+    are placed in the list instead of being raised. Otherwise, the first
+    exception is raised after all responses have been read (so that the
+    stream stays in sync).
+
+    Note that the requests are written before any response is read, so
+    batches with very large arguments could fill up the pipe buffers. The
+    items of streamed results are buffered in memory, except for the last
+    call in the batch.
+    """
+
+    calls = [_normalize_call(x) for x in calls]
+    for func, args, kwargs in calls:
+      self._send_request(func, args, kwargs)
+    self.fwrite.flush()
+
+    results, error = [], None
+    for _ in calls:
+      try:
+        results.append(self._receive())
+      except Exception as exc:
+        if not return_exceptions and error is None:
+          error = exc
+        results.append(exc)
+    if error is not None:
+      raise error
+    return results
+
+
+class MultiplexIoProtocolClient:
+  """
+  Client for the #MultiplexIoProtocolHandler. Calls can be issued from
+  multiple threads at the same time and many calls can be in flight over
+  the same pair of streams. Responses are read by a background thread and
+  dispatched to the waiting callers by their request ID.
+  """
+
+  def __init__(self, fwrite, fread, stream_buffer=64, negotiate=None):
+    self.fwrite = fwrite
+    self.fread = fread
+    self.stream_buffer = stream_buffer
+    self.codec = PickleCodec()
+    self._negotiate = negotiate
+    self._handshake_lock = threading.Lock()
+    self._lock = threading.Lock()
+    self._request_ids = itertools.count()
+    self._pending = {}
+    self._streams = {}
+    self._closed = False
+    self._reader_thread = threading.Thread(target=self._read_responses)
+    self._reader_thread.daemon = True
+    self._reader_thread.start()
+
+  def _read_responses(self):
+    try:
+      while True:
+        header = self.fread.read(V2_HEADER.size)
+        if len(header) < V2_HEADER.size:
+          break
+        response_size, request_id = V2_HEADER.unpack(header)
+        response = self.codec.receive(self.fread, response_size)
+        try:
+          response = self.codec.decode(response)
+        except Exception as exc:
+          response = ('exception', exc)
+        stream = self._streams.get(request_id)
+        if stream is not None:
+          if response[0] != 'yield':
+            del self._streams[request_id]
+          # Never blocks, the handler does not send more items than the
+          # stream granted credit for.
+          stream.put(response)
+          continue
+        with self._lock:
+          future = self._pending.pop(request_id, None)
+        if future is None:
+          continue
+        if response[0] == 'generator':
+          stream = _QueueRemoteIterator(self, request_id, self.stream_buffer)
+          self._streams[request_id] = stream
+          future.set_result(stream)
+          continue
+        try:
+          future.set_result(unpack_response(response))
+        except BaseException as exc:
+          future.set_exception(exc)
+    except (OSError, ValueError):
+      pass  # The stream has been closed.
+    finally:
+      with self._lock:
+        self._closed = True
+        pending, self._pending = self._pending, {}
+      for future in pending.values():
+        future.set_exception(EOFError('remotepy connection closed'))
+      for stream in self._streams.values():
+        stream.put(('exception', EOFError('remotepy connection closed')))
+      self._streams.clear()
+
+  def _send(self, request):
+    chunks = self.codec.encode(request)
+    future = concurrent.futures.Future()
+    with self._lock:
+      if self._closed:
+        raise EOFError('remotepy connection closed')
+      request_id = next(self._request_ids) & 0xffffffff
+      self._pending[request_id] = future
+      write_frame(self.fwrite, chunks, request_id)
+      self.fwrite.flush()
+    return future
+
+  def _send_control(self, request_id, message):
+    # Sends a flow control frame for the stream with the *request_id*.
+    with self._lock:
+      if self._closed:
+        return
+      try:
+        write_frame(self.fwrite, self.codec.encode(message), request_id)
+        self.fwrite.flush()
+      except (OSError, ValueError):
+        pass  # The reader thread notices the closed connection.
+
+  def _handshake(self):
+    with self._handshake_lock:
+      if self._negotiate is None:
+        return
+      # Other calls wait for the lock until the handshake is complete, thus
+      # no other request is in flight and the reader thread does not read
+      # another frame before the codec is switched.
+      try:
+        settings = self._send({'hello': hello_request(**self._negotiate)}).result()
+      except KeyError:
+        settings = None  # The handler does not support the handshake.
+      if settings is not None:
+        self.codec = NegotiatedCodec(**settings)
+      # Cleared only after the codec is switched, as #submit() checks it
+      # without holding the lock.
+      self._negotiate = None
+
+  def submit(self, __func, *args, **kwargs):
+    """
+    Sends a request and returns a #concurrent.futures.Future for the result.
+    """
+
+    if self._negotiate is not None:
+      self._handshake()
+    return self._send({'function': __func, 'args': args, 'kwargs': kwargs,
+                       'window': self.stream_buffer})
+
+  def call(self, __func, *args, **kwargs):
+    """
+    Calls *__func* on the remote and returns its return value. If the
+    function returns a generator, a #RemoteIterator is returned. The remote
+    produces at most #stream_buffer items ahead of the consumer, so the
+    iterator should be consumed or closed to not keep a worker of the
+    handler waiting.
+    """
+
+    return self.submit(__func, *args, **kwargs).result()
+
+  def call_many(self, calls, return_exceptions=False):
+    """
+    Like #IoProtocolClient.call_many(), but the calls are executed
+    concurrently on the remote.
+    """
+
+    futures = [self.submit(func, *args, **kwargs)
+               for func, args, kwargs in map(_normalize_call, calls)]
+    results, error = [], None
+    for future in futures:
+      try:
+        results.append(future.result())
+      except Exception as exc:
+        if not return_exceptions and error is None:
+          error = exc
+        results.append(exc)
+    if error is not None:
+      raise error
+    return results
+
+
+class RemoteIterator:
+  """
+  Iterates over the items of a streamed response, which is returned for
+  remote functions that return a generator. The items are read as they
+  arrive. The return value of the generator is available as #value once
+  the iterator is exhausted.
+  """
+
+  def __init__(self, read_frame):
+    self._read_frame = read_frame
+    self._buffer = collections.deque()
+    self._finished = False
+    self.value = None
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self._buffer:
+      frame = self._buffer.popleft()
+    elif self._finished:
+      raise StopIteration(self.value)
     else:
-      raise RuntimeError('protocol error, unknown result type {!r}'.format(type_))
+      frame = self._read_frame()
+      self._finished = (frame[0] != 'yield')
+    type_, data = frame
+    if type_ == 'yield':
+      return data
+    elif type_ == 'return':
+      self.value = data
+      raise StopIteration(data)
+    return unpack_response(frame)
+
+  def drain(self):
+    """
+    Reads the remaining frames of the response into memory.
+    """
+
+    while not self._finished:
+      frame = self._read_frame()
+      self._buffer.append(frame)
+      self._finished = (frame[0] != 'yield')
+
+  def close(self):
+    """
+    Discards the remaining items. The frames that are still to come are
+    read from the connection, but not kept in memory.
+    """
+
+    self._buffer.clear()
+    while not self._finished:
+      self._finished = (self._read_frame()[0] != 'yield')
+
+
+class _QueueRemoteIterator(RemoteIterator):
+  """
+  A #RemoteIterator that is fed by the reader thread of the
+  #MultiplexIoProtocolClient through a queue. The queue holds at most
+  *window* items as the consumed items are credited back to the handler
+  in batches (see #StreamWindow).
+  """
+
+  def __init__(self, client, request_id, window):
+    self._queue = queue.Queue()
+    self._discarded = False
+    self._client = client
+    self._request_id = request_id
+    self._batch = max(1, window // 2)
+    self._consumed = 0
+    super().__init__(self._next_frame)
+
+  def _next_frame(self):
+    frame = self._queue.get()
+    if frame[0] == 'yield':
+      self._consumed += 1
+      if self._consumed >= self._batch:
+        self._client._send_control(self._request_id, {'credit': self._consumed})
+        self._consumed = 0
+    return frame
+
+  def put(self, frame):
+    if not self._discarded:
+      self._queue.put_nowait(frame)
+
+  def close(self):
+    if not self._finished:
+      self._client._send_control(self._request_id, {'cancel': True})
+    self._discarded = True
+    self._finished = True
+    self._buffer.clear()
+    while True:
+      try:
+        self._queue.get_nowait()
+      except queue.Empty:
+        break
+
+
+def hello_request(compression=None, threshold=4096, oob_threshold=65536):
+  """
+  Returns the handshake request for the given options. *compression* may be
+  `'zlib'`, `'lzma'` or #None. Pickle streams larger than *threshold* bytes
+  are compressed. Buffers of at least *oob_threshold* bytes are sent out of
+  band (#None to disable).
+  """
+
+  return {
+    'protocol': pickle.HIGHEST_PROTOCOL,
+    'compression': [compression] if compression else [],
+    'threshold': threshold,
+    'oob_threshold': oob_threshold,
+  }
+
+
+def _normalize_call(call):
+  call = tuple(call)
+  func, args, kwargs = call + ((), {})[len(call) - 1:]
+  return func, tuple(args), dict(kwargs)
+
+
+def unpack_response(response):
+  """
+  Unpacks a `(type, data)` response tuple as sent by the
+  #IoProtocolHandler. Returns the return value or raises the exception.
+  """
+
+  type_, data = response
+  if type_ == 'return':
+    return data
+  elif type_ == 'exception':
+    raise data
+  else:
+    raise RuntimeError('protocol error, unknown result type {!r}'.format(type_))
 
 
 class SSHClient:
   """
   A client that runs this module on the remote via OpenSSH.
+
+  If *bootstrap* is #True, docker-remote does not need to be installed on
+  the remote. Instead, the sources are sent to a stub started with the
+  *python* interpreter on the remote (see #docker_remote.core.bootstrap).
+
+  The *ssh_options* are passed to every `ssh` invocation, for example to
+  share a ControlMaster connection (see #tunnel.control_master_options()).
   """
 
-  def __init__(self, host, username=None, password=None, read_stderr=True, tool_name=None):
+  def __init__(self, host, username=None, password=None, read_stderr=True,
+               tool_name=None, multiplex=False, daemon=False, bootstrap=False,
+               python='python3', negotiate=None, ssh_options=None):
     self.host = host
     self.username = username
     self.password = password
     self.read_stderr = read_stderr
     self.tool_name = tool_name or TOOL_NAME
+    self.multiplex = multiplex
+    self.daemon = daemon
+    self.bootstrap = bootstrap
+    self.python = python
+    self.negotiate = negotiate
+    self.ssh_options = list(ssh_options or [])
+    self._bootstrap_pending = False
+    self._uploaded = False
 
     if password:
       raise NotImplementedError('can not use OpenSSH with password')
 
-  def __enter__(self):
-    host = self.host
+  @property
+  def host_string(self):
     if self.username:
-      host = '{}@{}'.format(self.username, host)
-    command = ['ssh', host, self.tool_name, '--ioproto']
+      return '{}@{}'.format(self.username, self.host)
+    return self.host
+
+  def _start(self, upload=False):
+    args = ioproto_args(self.multiplex, self.daemon)
+    if self.bootstrap:
+      if self.daemon:
+        # Sessions with different sources must not share a daemon.
+        args += ['--socket', bootstrap.socket_path()]
+      command = ['ssh'] + self.ssh_options + [self.host_string]
+      command += bootstrap.stub_command(self.python, upload, args)
+    else:
+      command = ['ssh'] + self.ssh_options + [self.host_string, self.tool_name] + args
     self._proc = shell_popen(command, stdin=subprocess.PIPE,
       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdin, stdout, stderr = self._proc.stdin, self._proc.stdout, self._proc.stderr
@@ -149,16 +953,59 @@ class SSHClient:
     else:
       stderr.close()
 
-    self._client = IoProtocolClient(stdin, stdout)
-    return self
+    self._uploaded = upload
+    if upload:
+      # Written without waiting for a response, thus the upload does not
+      # cost an additional round trip.
+      stdin.write(bootstrap.pack_sources())
+    self._client = create_ioproto_client(stdin, stdout, self.multiplex,
+      self.negotiate)
 
-  def __exit__(self, *a):
+  def _stop(self):
     [x.close() for x in self._pipes]
     self._proc.terminate()
     self._proc.wait()
 
+  def __enter__(self):
+    upload = False
+    if self.bootstrap:
+      upload = not bootstrap.is_cached_on(self.host_string)
+      self._bootstrap_pending = True
+    self._start(upload)
+    return self
+
+  def __exit__(self, *a):
+    self._stop()
+
+  def _call(self, method, *args, **kwargs):
+    if not self._bootstrap_pending:
+      return getattr(self._client, method)(*args, **kwargs)
+
+    # The first call tells us whether the bootstrap was successful. If the
+    # sources were expected to be cached on the remote but are not, the
+    # stub exits without handling the request and we retry with an upload.
+    try:
+      result = getattr(self._client, method)(*args, **kwargs)
+    except (EOFError, struct.error):
+      try:
+        code = self._proc.wait(timeout=10)
+      except subprocess.TimeoutExpired:
+        raise
+      if code != bootstrap.EXIT_MISSING:
+        raise
+      self._stop()
+      self._start(upload=True)
+      result = getattr(self._client, method)(*args, **kwargs)
+    self._bootstrap_pending = False
+    if self._uploaded:
+      bootstrap.set_cached_on(self.host_string)
+    return result
+
   def call(self, *args, **kwargs):
-    return self._client.call(*args, **kwargs)
+    return self._call('call', *args, **kwargs)
+
+  def call_many(self, *args, **kwargs):
+    return self._call('call_many', *args, **kwargs)
 
 
 class LocalClient:
@@ -166,11 +1013,17 @@ class LocalClient:
   A client that runs this module on the same machine in another process.
   """
 
+  def __init__(self, multiplex=False, daemon=False, negotiate=None):
+    self.multiplex = multiplex
+    self.daemon = daemon
+    self.negotiate = negotiate
+
   def __enter__(self):
-    command = [TOOL_NAME, '--ioproto']
+    command = [TOOL_NAME] + ioproto_args(self.multiplex, self.daemon)
     self._proc = shell_popen(command, stdin=subprocess.PIPE,
       stdout=subprocess.PIPE)
-    self._client = IoProtocolClient(self._proc.stdin, self._proc.stdout)
+    self._client = create_ioproto_client(self._proc.stdin, self._proc.stdout,
+      self.multiplex, self.negotiate)
     return self
 
   def __exit__(self, *a):
@@ -181,6 +1034,199 @@ class LocalClient:
   def call(self, *args, **kwargs):
     return self._client.call(*args, **kwargs)
 
+  def call_many(self, *args, **kwargs):
+    return self._client.call_many(*args, **kwargs)
+
+
+#: Maps the first byte sent over a connection to the #DaemonServer to the
+#: handler class for the connection.
+DAEMON_PROTOCOLS = {b'1': IoProtocolHandler, b'2': MultiplexIoProtocolHandler}
+
+
+class DaemonServer:
+  """
+  A long-running server that handles remotepy sessions over a Unix socket,
+  avoiding the interpreter startup and import costs for every session. The
+  first byte sent over a connection selects the protocol (`1` for the
+  #IoProtocolHandler, `2` for the #MultiplexIoProtocolHandler). The server
+  shuts down when no connection has been active for *idle_timeout* seconds.
+
+  Note that modules imported by the daemon (for example the docker-remote
+  configuration) are only loaded once for the lifetime of the daemon.
+
+  The *protocols* replace the #DAEMON_PROTOCOLS, for example to serve
+  sessions with a handler that overrides #IoProtocolHandler._call().
+  """
+
+  def __init__(self, path, idle_timeout=600, log_exception=False,
+               protocols=None):
+    self.path = path
+    self.idle_timeout = idle_timeout
+    self.log_exception = log_exception
+    self.protocols = DAEMON_PROTOCOLS if protocols is None else protocols
+    self._lock = threading.Lock()
+    self._active = 0
+    self._last_active = time.time()
+
+  def _bind(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.bind(self.path)
+    except OSError as exc:
+      if exc.errno != errno.EADDRINUSE or is_daemon_running(self.path):
+        sock.close()
+        raise
+      # Stale socket file from a daemon that did not shut down cleanly.
+      os.remove(self.path)
+      sock.bind(self.path)
+    os.chmod(self.path, 0o600)
+    sock.listen(16)
+    return sock
+
+  def _handle_connection(self, conn):
+    try:
+      with conn, conn.makefile('rb') as fread, conn.makefile('wb') as fwrite:
+        handler_class = self.protocols.get(fread.read(1))
+        if handler_class is None:
+          return
+        with handler_class(fread, fwrite, self.log_exception) as handler:
+          while handler.handle_request():
+            pass
+    finally:
+      with self._lock:
+        self._active -= 1
+        self._last_active = time.time()
+
+  def _start_connection(self, conn):
+    conn.setblocking(True)
+    with self._lock:
+      self._active += 1
+    thread = threading.Thread(target=self._handle_connection, args=(conn,))
+    thread.start()
+
+  def _is_idle(self):
+    with self._lock:
+      return self._active == 0 and time.time() - self._last_active > self.idle_timeout
+
+  def serve_forever(self):
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    sock = self._bind()
+    try:
+      sock.settimeout(1.0)
+      while not self._is_idle():
+        try:
+          conn = sock.accept()[0]
+        except socket.timeout:
+          continue
+        self._start_connection(conn)
+    finally:
+      # Remove the socket file first so that no new clients connect, then
+      # serve the connections that are still in the backlog.
+      os.remove(self.path)
+      sock.setblocking(False)
+      while True:
+        try:
+          conn = sock.accept()[0]
+        except OSError:
+          break
+        self._start_connection(conn)
+      sock.close()
+
+
+def is_daemon_running(path):
+  """
+  Returns #True if a #DaemonServer is accepting connections on *path*.
+  """
+
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    try:
+      sock.connect(path)
+    except OSError:
+      return False
+  return True
+
+
+def spawn_daemon(path, idle_timeout=None):
+  """
+  Starts a #DaemonServer in a detached background process.
+  """
+
+  command = [sys.executable, '-m', 'docker_remote.core.remotepy', '--serve',
+    '--socket', path]
+  if idle_timeout is not None:
+    command += ['--idle-timeout', str(idle_timeout)]
+  # Make sure that the daemon imports the same docker_remote package, even
+  # if it is not installed (see #docker_remote.core.bootstrap).
+  package_parent = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+  env = os.environ.copy()
+  env['PYTHONPATH'] = os.pathsep.join(filter(bool, [package_parent,
+    env.get('PYTHONPATH')]))
+  return subprocess.Popen(command, stdin=subprocess.DEVNULL,
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True,
+    start_new_session=True, env=env)
+
+
+def bridge_to_daemon(path, multiplex=False):
+  """
+  Connects the standard input and output of the current process to the
+  #DaemonServer listening on *path*. Returns #False if no daemon is
+  listening, otherwise returns #True once the session has ended.
+  """
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except OSError:
+    sock.close()
+    return False
+
+  def forward_stdin():
+    while True:
+      data = os.read(0, 65536)
+      if not data:
+        break
+      sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+  with sock:
+    sock.sendall(b'2' if multiplex else b'1')
+    thread = threading.Thread(target=forward_stdin)
+    thread.daemon = True
+    thread.start()
+    while True:
+      data = sock.recv(65536)
+      if not data:
+        break
+      while data:
+        data = data[os.write(1, data):]
+  return True
+
+
+def ioproto_args(multiplex=False, daemon=False):
+  """
+  Returns the command-line arguments for this module to start a handler.
+  """
+
+  args = ['--ioproto']
+  if multiplex:
+    args.append('--multiplex')
+  if daemon:
+    args.append('--daemon')
+  return args
+
+
+def create_ioproto_client(fwrite, fread, multiplex=False, negotiate=None):
+  """
+  Creates an #IoProtocolClient or #MultiplexIoProtocolClient.
+  """
+
+  if multiplex:
+    return MultiplexIoProtocolClient(fwrite, fread, negotiate=negotiate)
+  return IoProtocolClient(fwrite, fread, negotiate=negotiate)
+
 
 def get_module_member(module_name, member):
   module = __import__(module_name, fromlist=[None])
@@ -194,13 +1240,46 @@ def main(argv=None, prog=None):
          'standard input stream is closed. As a client, you can use the '
          'IoProtocolClient or more convenient SSHClient or LocalClient '
          'classes to communicate with the process.')
+  parser.add_argument('--multiplex', action='store_true',
+    help='Use the multiplexed protocol with --ioproto. Requests are handled '
+         'concurrently in a thread pool and responses may be sent out of '
+         'order. Use the MultiplexIoProtocolClient to communicate with the '
+         'process.')
+  parser.add_argument('--workers', type=int,
+    help='The maximum number of threads to handle requests with when '
+         '--multiplex is used.')
+  parser.add_argument('--daemon', action='store_true',
+    help='Use with --ioproto. Forward the session to the daemon listening '
+         'on --socket. If no daemon is running, one is started in the '
+         'background for subsequent sessions and this session is handled '
+         'in-process.')
+  parser.add_argument('--serve', action='store_true',
+    help='Run the daemon that handles sessions over the Unix socket '
+         'specified with --socket.')
+  parser.add_argument('--socket', default=DEFAULT_SOCKET,
+    help='The path to the Unix socket of the daemon. Defaults to {}.'
+         .format(DEFAULT_SOCKET))
+  parser.add_argument('--idle-timeout', type=float, default=600,
+    help='The number of seconds without active sessions after which the '
+         'daemon shuts down. Defaults to 600.')
   args = parser.parse_args(argv)
+  socket_path = os.path.expanduser(args.socket)
 
-  if args.ioproto:
+  if args.serve:
+    DaemonServer(socket_path, args.idle_timeout).serve_forever()
+  elif args.ioproto:
     def noop(signal, frame):
       pass
     signal.signal(signal.SIGINT, noop)
-    with IoProtocolHandler() as handler:
+    if args.daemon:
+      if bridge_to_daemon(socket_path, args.multiplex):
+        return
+      spawn_daemon(socket_path, args.idle_timeout)
+    if args.multiplex:
+      handler = MultiplexIoProtocolHandler(max_workers=args.workers)
+    else:
+      handler = IoProtocolHandler()
+    with handler:
       while handler.handle_request():
         pass
   else:
@@ -208,4 +1287,7 @@ def main(argv=None, prog=None):
 
 
 if __name__ == '__main__':
-  main()
+  # Run from the imported module so that objects pickled by the handler
+  # reference docker_remote.core.remotepy instead of __main__.
+  from docker_remote.core import remotepy
+  remotepy.main()
@@ -22,38 +22,173 @@
 Create an SSH tunnel via the `ssh` client program.
 """
 
+import asyncio
+import itertools
+import os
+import socket
 import subprocess
+import threading
 import time
 
 
+def control_master_options(control_path, persist='10m'):
+  """
+  Returns the `ssh` options to share a single OpenSSH ControlMaster
+  connection per host between all `ssh` and `scp` invocations. The first
+  invocation becomes the master and, thanks to *persist*, stays in the
+  background so that subsequent invocations skip the TCP and authentication
+  handshake.
+  """
+
+  return ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + control_path,
+          '-o', 'ControlPersist={}'.format(persist)]
+
+
+def uses_control_master(ssh_options):
+  return any(x.startswith('ControlPath=') for x in ssh_options)
+
+
+def find_free_port():
+  """
+  Returns a local TCP port that is currently not in use.
+  """
+
+  with socket.socket() as sock:
+    sock.bind(('localhost', 0))
+    return sock.getsockname()[1]
+
+
+def is_socket_path(local_port):
+  return isinstance(local_port, str) and not local_port.isdigit()
+
+
 class SSHTunnel:
+  """
+  Forwards the *local_port* to the *remote_port* on the host. If the
+  *ssh_options* configure a ControlMaster (see #control_master_options()),
+  the forwarding is added to the master connection instead of opening a
+  new connection, and it is cancelled again on exit. As `ControlPersist`
+  only counts sessions and not forwardings, a session that idles on the
+  host keeps the master connection open while the tunnel exists.
+
+  The *local_port* may also be the path of a Unix socket.
+
+  Entering the tunnel does not wait for the connection to be established.
+  Use #wait_ready() before the forwarded port is used.
+  """
 
-  def __init__(self, host, user, password, local_port, remote_port):
+  def __init__(self, host, user, password, local_port, remote_port,
+               ssh_options=None):
     self.host = host
     self.user = user
     self.password = password
     self.local_port = local_port
     self.remote_port = remote_port
+    self.ssh_options = list(ssh_options or [])
+    self._proc = None
+    self._keeper = None
+    self._thread = None
+    self._error = None
 
   def __repr__(self):
     return 'SSHTunnel({!r})'.format(self.ssh_command())
 
   def __enter__(self):
-    self._proc = subprocess.Popen(self.ssh_command())
+    if uses_control_master(self.ssh_options):
+      self._thread = threading.Thread(target=self._forward_via_master)
+      self._thread.daemon = True
+      self._thread.start()
+    else:
+      self._proc = subprocess.Popen(self.ssh_command())
     return self
 
   def __exit__(self, *a):
-    self._proc.terminate()
-    self._proc.wait()
+    if self._proc is None:
+      self._thread.join()
+      self._control('cancel', '-L', self.mapping)
+      if self._keeper is not None:
+        self._keeper.stdin.close()
+        try:
+          self._keeper.wait(5)
+        except subprocess.TimeoutExpired:
+          self._keeper.terminate()
+          self._keeper.wait()
+    else:
+      self._proc.terminate()
+      self._proc.wait()
 
-  def ssh_command(self):
-    mapping = '{}:{}'.format(self.local_port, self.remote_port)
-    host = self.host
+  def _forward_via_master(self):
+    try:
+      if self._control('check') != 0:
+        # Establishes the master connection, which persists in the background.
+        subprocess.check_call(['ssh'] + self.ssh_options + [self.host_string, 'true'])
+      # Runs until its standard input is closed in #__exit__().
+      self._keeper = subprocess.Popen(['ssh'] + self.ssh_options + [self.host_string, 'cat'],
+        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+      if self._control('forward', '-L', self.mapping) != 0:
+        raise RuntimeError('unable to forward {} via {}'.format(self.mapping, self.host_string))
+    except Exception as exc:
+      self._error = exc
+
+  def _probe(self):
+    try:
+      if is_socket_path(self.local_port):
+        with socket.socket(socket.AF_UNIX) as sock:
+          sock.settimeout(1)
+          sock.connect(self.local_port)
+      else:
+        socket.create_connection(('localhost', self.local_port), 1).close()
+    except OSError:
+      return False
+    return True
+
+  def wait_ready(self, timeout=30):
+    """
+    Waits until the forwarded port accepts connections. Raises a
+    #RuntimeError if the tunnel fails or the *timeout* expires.
+    """
+
+    deadline = time.time() + timeout
+    if self._thread is not None:
+      self._thread.join(timeout)
+      if self._error is not None:
+        raise self._error
+    while not self._probe():
+      if self._proc is not None and self._proc.poll() is not None:
+        raise RuntimeError('SSH tunnel exited with {}'.format(self._proc.returncode))
+      if time.time() > deadline:
+        raise RuntimeError('SSH tunnel not ready after {} seconds'.format(timeout))
+      time.sleep(0.05)
+
+  def _control(self, command, *args):
+    command = ['ssh'] + self.ssh_options + ['-O', command] + list(args) + [self.host_string]
+    return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  @property
+  def host_string(self):
     if self.user:
-      host = '{}@{}'.format(self.user, host)
-    return ['ssh', '-NL', mapping, host]
+      return '{}@{}'.format(self.user, self.host)
+    return self.host
+
+  @property
+  def mapping(self):
+    return '{}:{}'.format(self.local_port, self.remote_port)
+
+  def ssh_command(self):
+    # Fail instead of running without the forwarding if the local port was
+    # taken in the meantime.
+    return ['ssh'] + self.ssh_options + ['-o', 'ExitOnForwardFailure=yes',
+      '-NL', self.mapping, self.host_string]
 
   def status(self):
+    if self._proc is None:
+      if self._thread.is_alive():
+        return 'alive'  # Still connecting, see #wait_ready().
+      if self._error is not None:
+        return 'error'
+      if self._keeper is not None and self._keeper.poll() is not None:
+        return 'error'
+      return 'alive' if self._control('check') == 0 else 'error'
     code = self._proc.poll()
     if code is None:
       return 'alive'
@@ -61,3 +196,207 @@ class SSHTunnel:
       return 'ended'
     else:
       return 'error'
+
+
+class ConnectionStats:
+  """
+  Traffic counters of a connection through the #DialStdioTunnel. A latency
+  sample is the time between a request from the client after the previous
+  response and the first byte of the next response.
+  """
+
+  def __init__(self, id):
+    self.id = id
+    self.opened = time.time()
+    self.closed = None
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.latencies = []
+    self._request_started = None
+
+  def __repr__(self):
+    return 'ConnectionStats(id={!r}, sent={}, received={}, latency={})'.format(
+      self.id, self.bytes_sent, self.bytes_received, self.mean_latency)
+
+  def on_sent(self, size):
+    self.bytes_sent += size
+    if self._request_started is None:
+      self._request_started = time.perf_counter()
+
+  def on_received(self, size):
+    self.bytes_received += size
+    if self._request_started is not None:
+      self.latencies.append(time.perf_counter() - self._request_started)
+      self._request_started = None
+
+  @property
+  def duration(self):
+    return (self.closed or time.time()) - self.opened
+
+  @property
+  def mean_latency(self):
+    if not self.latencies:
+      return None
+    return sum(self.latencies) / len(self.latencies)
+
+  @property
+  def max_latency(self):
+    return max(self.latencies) if self.latencies else None
+
+
+def format_stats(stats):
+  """
+  Returns a human readable summary of a list of #ConnectionStats.
+  """
+
+  latencies = [x for s in stats for x in s.latencies]
+  lines = ['{} connections, {} bytes sent, {} bytes received'.format(
+    len(stats), sum(s.bytes_sent for s in stats), sum(s.bytes_received for s in stats))]
+  if latencies:
+    lines[0] += ', latency mean {:.1f}ms max {:.1f}ms'.format(
+      sum(latencies) / len(latencies) * 1000, max(latencies) * 1000)
+  for s in stats:
+    line = '  #{}: {} bytes sent, {} bytes received, {} requests in {:.2f}s'.format(
+      s.id, s.bytes_sent, s.bytes_received, len(s.latencies), s.duration)
+    if s.latencies:
+      line += ', latency mean {:.1f}ms max {:.1f}ms'.format(
+        s.mean_latency * 1000, s.max_latency * 1000)
+    lines.append(line)
+  return '\n'.join(lines)
+
+
+class DialStdioTunnel:
+  """
+  Forwards connections to the Unix socket *local_socket* to the Docker
+  daemon on the host. Every connection is spliced onto the standard input
+  and output of `ssh host docker system dial-stdio`. With a ControlMaster
+  (see #control_master_options()), these are multiplexed over a single SSH
+  connection. Unlike the #SSHTunnel, no TCP port is opened, and the traffic
+  of every connection is recorded in a #ConnectionStats object.
+
+  The forwarder runs an asyncio event loop in a background thread.
+  """
+
+  buffer_size = 65536
+
+  def __init__(self, host, user, local_socket, ssh_options=None,
+               command=None):
+    self.host = host
+    self.user = user
+    self.local_socket = local_socket
+    self.ssh_options = list(ssh_options or [])
+    self.command = list(command or ['docker', 'system', 'dial-stdio'])
+    self.stats = []
+    self._ids = itertools.count(1)
+    self._ready = threading.Event()
+    self._error = None
+    self._loop = None
+    self._stop = None
+    self._thread = None
+
+  def __repr__(self):
+    return 'DialStdioTunnel({!r}, {!r})'.format(self.local_socket, self.ssh_command())
+
+  def __enter__(self):
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def __exit__(self, *a):
+    # The stop event is created by the background thread, which may not
+    # have got that far yet. It is ready once the server listens or failed.
+    self._ready.wait()
+    if self._error is None:
+      self._loop.call_soon_threadsafe(self._stop.set)
+    self._thread.join()
+
+  @property
+  def host_string(self):
+    if self.user:
+      return '{}@{}'.format(self.user, self.host)
+    return self.host
+
+  @property
+  def local_port(self):
+    return self.local_socket
+
+  def ssh_command(self):
+    return ['ssh'] + self.ssh_options + [self.host_string] + self.command
+
+  def _run(self):
+    self._loop = asyncio.new_event_loop()
+    try:
+      self._loop.run_until_complete(self._serve())
+    except Exception as exc:
+      self._error = exc
+    finally:
+      self._ready.set()
+      self._loop.close()
+
+  async def _serve(self):
+    self._stop = asyncio.Event()
+    connections = set()
+    def handle(reader, writer):
+      task = asyncio.ensure_future(self._handle_connection(reader, writer))
+      connections.add(task)
+      task.add_done_callback(connections.discard)
+    server = await asyncio.start_unix_server(handle, self.local_socket)
+    self._ready.set()
+    try:
+      await self._stop.wait()
+    finally:
+      server.close()
+      for task in list(connections):
+        task.cancel()
+      await asyncio.gather(*connections, return_exceptions=True)
+      await server.wait_closed()
+      if os.path.exists(self.local_socket):
+        os.remove(self.local_socket)
+
+  async def _pump(self, reader, writer, counter):
+    try:
+      while True:
+        data = await reader.read(self.buffer_size)
+        if not data:
+          break
+        counter(len(data))
+        writer.write(data)
+        await writer.drain()
+      if writer.can_write_eof():
+        writer.write_eof()
+    except (ConnectionError, OSError):
+      pass
+
+  async def _handle_connection(self, reader, writer):
+    stats = ConnectionStats(next(self._ids))
+    self.stats.append(stats)
+    proc = await asyncio.create_subprocess_exec(*self.ssh_command(),
+      stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+      stderr=asyncio.subprocess.DEVNULL)
+    try:
+      await asyncio.gather(
+        self._pump(reader, proc.stdin, stats.on_sent),
+        self._pump(proc.stdout, writer, stats.on_received))
+    finally:
+      stats.closed = time.time()
+      writer.close()
+      proc.stdin.close()
+      if proc.returncode is None:
+        proc.terminate()
+      await proc.wait()
+
+  def wait_ready(self, timeout=30):
+    """
+    Waits until the local socket accepts connections.
+    """
+
+    if not self._ready.wait(timeout):
+      raise RuntimeError('Docker forwarder not ready after {} seconds'.format(timeout))
+    if self._error is not None:
+      raise self._error
+
+  def status(self):
+    if self._thread.is_alive():
+      return 'alive'
+    return 'error' if self._error is not None else 'ended'
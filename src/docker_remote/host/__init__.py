@@ -19,8 +19,13 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+from . import blobs
+from . import compose
 from . import dockerhost
+from . import files
 from . import projects
+from . import stats
+from . import sync
 
 
 def get_version():
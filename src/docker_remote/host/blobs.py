@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+A content-addressed store for files that are uploaded to the host. Every
+file is stored once under its SHA256 hash in `.blobs` in the project root,
+thus uploading the same content again transfers nothing.
+"""
+
+import os
+import re
+import shutil
+
+from . import projects
+
+#: The directory that contains the blobs.
+BLOB_DIR = os.path.join(projects.PROJECT_ROOT, '.blobs')
+
+
+def get_blob_path(digest):
+  if not re.match('^[0-9a-f]{64}$', digest):
+    raise ValueError('invalid SHA256 hash: {!r}'.format(digest))
+  return os.path.join(BLOB_DIR, digest)
+
+
+def missing_blobs(digests):
+  """
+  Returns a dictionary that maps the hashes in *digests* that are not in
+  the store to the paths that they must be uploaded to (for example with
+  #files.write_chunk() and #files.finish_put(), which verifies the hash).
+  """
+
+  os.makedirs(BLOB_DIR, exist_ok=True)
+  result = {}
+  for digest in digests:
+    path = get_blob_path(digest)
+    if not os.path.isfile(path):
+      result[digest] = path
+  return result
+
+
+def link_blob(digest, path):
+  """
+  Makes the file *path* a copy of the blob with the hash *digest*. A hard
+  link is used if possible. Blobs must not be modified through *path*.
+  """
+
+  blob = get_blob_path(digest)
+  if os.path.lexists(path):
+    os.remove(path)
+  try:
+    os.link(blob, path)
+  except OSError:
+    shutil.copyfile(blob, path)
+
+
+def copy_blobs(items):
+  """
+  Copies blobs into place for every `(digest, path, mode, mtime)` tuple in
+  *items*, creating the parent directories as needed. Unlike
+  #link_blob(), the files are real copies, so that they can be modified
+  (for example in a volume of a container) without changing the blob.
+  """
+
+  for digest, path, mode, mtime in items:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.docker-remote-part'
+    shutil.copyfile(get_blob_path(digest), tmp)
+    os.chmod(tmp, mode)
+    os.utime(tmp, (mtime, mtime))
+    os.replace(tmp, path)
@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Runs docker-compose on the host, so that the Docker API calls of compose do
+not have to cross the tunnel.
+"""
+
+import os
+import selectors
+import subprocess
+
+from . import projects
+
+#: The name of the compose file in the project directory.
+COMPOSE_FILENAME = '.docker-remote-compose.yml'
+
+
+def run_compose(project_name, compose_yaml, argv, command=None,
+                deploy_fingerprint=None, env=None):
+  """
+  Writes the rendered *compose_yaml* to the project directory and runs
+  docker-compose with *argv* in the project directory. This is a generator
+  that yields `('stdout', data)` and `('stderr', data)` tuples as the output
+  becomes available and returns the exit code of docker-compose. If the
+  generator is closed early, docker-compose is terminated.
+
+  If *deploy_fingerprint* is specified, it is recorded with
+  #projects.set_deploy_fingerprint() if docker-compose succeeds. The *env*
+  dictionary is added to the environment of docker-compose, usually the
+  variables that the compose file refers to on the client.
+  """
+
+  project_path = projects.get_project_path(project_name)
+  filename = os.path.join(project_path, COMPOSE_FILENAME)
+  with open(filename, 'w') as fp:
+    fp.write(compose_yaml)
+
+  command = list(command or ['docker-compose'])
+  command += ['-p', project_name, '-f', filename, '--project-directory', project_path]
+  command += argv
+  proc = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=project_path,
+    env=dict(os.environ, **env) if env else None)
+  finished = False
+  try:
+    with selectors.DefaultSelector() as selector:
+      selector.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+      selector.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+      while selector.get_map():
+        for key, _ in selector.select():
+          data = os.read(key.fileobj.fileno(), 65536)
+          if not data:
+            selector.unregister(key.fileobj)
+          else:
+            yield key.data, data
+    finished = True
+  finally:
+    # The process may not have exited yet when its output is closed.
+    if not finished and proc.poll() is None:
+      proc.terminate()
+    proc.stdout.close()
+    proc.stderr.close()
+  code = proc.wait()
+  if code == 0 and deploy_fingerprint is not None:
+    projects.set_deploy_fingerprint(project_name, deploy_fingerprint)
+  return code
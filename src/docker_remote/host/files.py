@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Chunked file transfers over the remotepy session. Downloads stream the file
+with #get_file(). Uploads send the chunks with #write_chunk() (pipelined
+with #IoProtocolClient.call_many()) into a temporary file that
+#finish_put() verifies and moves into place. Both ends only hold a fixed
+number of chunks in memory, regardless of the size of the file.
+
+Chunks of at least `remote.oob_threshold` bytes are sent out-of-band, thus
+they are not copied into the pickle stream, but only with the
+#NegotiatedCodec, that is if the `remote.compression` option is set (`none`
+negotiates the codec without compression). Otherwise, the chunks are
+pickled in-band like any other value.
+"""
+
+import hashlib
+import os
+
+from .sync import hash_file
+
+#: The default size of the chunks.
+CHUNK_SIZE = 1024 * 1024
+
+#: The suffix of the temporary file of an upload.
+PART_SUFFIX = '.docker-remote-part'
+
+
+def get_file(path, chunk_size=CHUNK_SIZE):
+  """
+  Yields the contents of the file *path* in chunks of *chunk_size* bytes
+  and returns a tuple of its size and SHA256 hash.
+  """
+
+  hasher = hashlib.sha256()
+  size = 0
+  with open(path, 'rb') as fp:
+    while True:
+      # A new buffer for every chunk, the previous one may still be queued
+      # for sending.
+      buf = bytearray(chunk_size)
+      n = fp.readinto(buf)
+      if not n:
+        break
+      if n < chunk_size:
+        del buf[n:]
+      hasher.update(buf)
+      size += n
+      yield buf
+  return size, hasher.hexdigest()
+
+
+def write_chunk(path, offset, data):
+  """
+  Writes *data* at *offset* into the temporary file of the upload to
+  *path*. The chunks of an upload may be written concurrently and in any
+  order, thus the file is never truncated here, but in #finish_put().
+  """
+
+  part = path + PART_SUFFIX
+  with os.fdopen(os.open(part, os.O_WRONLY | os.O_CREAT, 0o666), 'wb') as fp:
+    fp.seek(offset)
+    fp.write(data)
+
+
+def finish_put(path, size, sha256, mode=None):
+  """
+  Completes the upload to *path*. The temporary file is truncated to
+  *size* bytes and moved into place if its SHA256 hash matches *sha256*.
+  Otherwise, it is removed and an #IOError is raised.
+  """
+
+  part = path + PART_SUFFIX
+  with open(part, 'ab') as fp:
+    fp.truncate(size)
+  digest = hash_file(part)
+  if digest != sha256:
+    os.remove(part)
+    raise IOError('checksum mismatch for {!r}: expected {}, got {}'.format(
+      path, sha256, digest))
+  if mode is not None:
+    os.chmod(part, mode)
+  os.replace(part, path)
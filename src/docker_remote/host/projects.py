@@ -27,11 +27,17 @@ import os
 import nr.fs
 import re
 import shutil
+import subprocess
 
+from . import dockerhost
 from .. import config
 
 PROJECT_ROOT = os.path.expanduser(config.get('host.project_root', '~/docker-remote-projects'))
 
+#: The name of the file in the project directory that contains the
+#: fingerprint of the last successful deployment.
+DEPLOY_FINGERPRINT_FILENAME = '.docker-remote-deployed'
+
 
 class ProjectError(Exception):
   pass
@@ -71,6 +77,8 @@ def list_projects():
     return []
   result = []
   for name in os.listdir(PROJECT_ROOT):
+    if name.startswith('.'):
+      continue  # Not a project, like the blob store.
     path = os.path.join(PROJECT_ROOT, name)
     if os.path.isdir(path):
       result.append(name)
@@ -78,7 +86,7 @@ def list_projects():
 
 
 def new_project(name):
-  if not re.match('^[\w\d\-\_\.]+$', name):
+  if not re.match('^[\w\d\-\_\.]+$', name) or name.startswith('.'):
     raise ValueError('invalid project name: {!r}'.format(name))
   project_path = get_project_path(name)
   if os.path.isdir(project_path):
@@ -101,3 +109,85 @@ def ensure_volume_dirs(name, dirs):
     if not os.path.isabs(dirname):
       dirname = os.path.join(project_path, dirname)
     nr.fs.makedirs(dirname)
+
+
+def get_deploy_fingerprint(name):
+  """
+  Returns the fingerprint of the last successful deployment of the project,
+  or #None.
+  """
+
+  filename = os.path.join(get_project_path(name), DEPLOY_FINGERPRINT_FILENAME)
+  try:
+    with open(filename) as fp:
+      return fp.read().strip() or None
+  except FileNotFoundError:
+    return None
+
+
+def set_deploy_fingerprint(name, fingerprint):
+  """
+  Records the *fingerprint* of a successful deployment of the project. If
+  *fingerprint* is #None, the record is removed.
+  """
+
+  filename = os.path.join(get_project_path(name), DEPLOY_FINGERPRINT_FILENAME)
+  if fingerprint is None:
+    if os.path.isfile(filename):
+      os.remove(filename)
+  else:
+    with open(filename, 'w') as fp:
+      fp.write(fingerprint)
+
+
+def get_running_services(name):
+  """
+  Returns the names of the services of the project that have a running
+  container, or #None if `docker ps` fails.
+  """
+
+  # The project name as normalized by docker-compose.
+  label = 'com.docker.compose.project=' + re.sub(r'[^-_a-z0-9]', '', name.lower())
+  try:
+    output = subprocess.check_output(['docker', 'ps', '--filter', 'label=' + label,
+      '--format', '{{.Label "com.docker.compose.service"}}'], stderr=subprocess.DEVNULL)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return sorted(set(output.decode().split()))
+
+
+def prepare_project(name, volumes, create_project=True, create_volumedirs=True,
+                    docker_host_ip=False):
+  """
+  Prepares the project *name* for a deployment in a single call. Relative
+  *volumes* paths that are not named volumes are resolved against the
+  project directory. Returns a dictionary with the following data:
+
+  * prefix: The project directory.
+  * path_module: The name of the #os.path module of the host.
+  * volumes: The resolved *volumes*.
+  * docker_host_ip: The Docker host IP if *docker_host_ip* is #True.
+  * deploy_fingerprint: See #get_deploy_fingerprint().
+
+  If *create_project* is #True, the project is created if it does not
+  exist. If *create_volumedirs* is #True, the volume directories are
+  created.
+  """
+
+  prefix = get_project_path(name)
+  if create_project and not project_exists(name):
+    new_project(name)
+  resolved = []
+  for path in volumes:
+    if not os.path.isabs(path) and '/' in path:
+      path = os.path.join(prefix, path)
+    resolved.append(path)
+  if create_volumedirs:
+    ensure_volume_dirs(name, resolved)
+  return {
+    'prefix': prefix,
+    'path_module': os.path.__name__,
+    'volumes': resolved,
+    'docker_host_ip': dockerhost.get_docker_host_ip() if docker_host_ip else None,
+    'deploy_fingerprint': get_deploy_fingerprint(name),
+  }
@@ -0,0 +1,113 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+This module reports the load of the host machine, which is used to place
+new projects on the least loaded host.
+"""
+
+import os
+import shutil
+import subprocess
+
+from . import projects
+
+
+def get_load_average():
+  try:
+    return list(os.getloadavg())
+  except (AttributeError, OSError):
+    return None
+
+
+def get_memory():
+  """
+  Returns a tuple of the total and the available memory in bytes, or
+  #None if it can not be determined (only Linux is supported).
+  """
+
+  values = {}
+  try:
+    with open('/proc/meminfo') as fp:
+      for line in fp:
+        key, _, value = line.partition(':')
+        values[key] = int(value.split()[0]) * 1024
+  except (OSError, ValueError, IndexError):
+    return None
+  if 'MemTotal' not in values:
+    return None
+  available = values.get('MemAvailable', values.get('MemFree', 0))
+  return values['MemTotal'], available
+
+
+def get_disk_usage(path):
+  """
+  Returns a tuple of the total and the free disk space in bytes of the
+  file system that contains *path*, or the closest existing parent.
+  """
+
+  path = os.path.abspath(path)
+  while not os.path.exists(path):
+    path = os.path.dirname(path)
+  usage = shutil.disk_usage(path)
+  return usage.total, usage.free
+
+
+def get_container_count():
+  """
+  Returns the number of running containers, or #None if `docker ps` fails.
+  """
+
+  try:
+    output = subprocess.check_output(['docker', 'ps', '-q'],
+      stderr=subprocess.DEVNULL)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return len(output.split())
+
+
+def get_host_stats():
+  """
+  Returns a dictionary with the following keys:
+
+  * load_average: The 1, 5 and 15 minute load averages.
+  * cpu_count: The number of CPUs.
+  * memory_total, memory_available: In bytes.
+  * disk_total, disk_free: In bytes, of the file system of the project root.
+  * containers: The number of running containers.
+
+  Values that can not be determined are #None.
+  """
+
+  memory = get_memory() or (None, None)
+  disk = get_disk_usage(projects.PROJECT_ROOT)
+  return {
+    'load_average': get_load_average(),
+    'cpu_count': os.cpu_count(),
+    'memory_total': memory[0],
+    'memory_available': memory[1],
+    'disk_total': disk[0],
+    'disk_free': disk[1],
+    'containers': get_container_count(),
+  }
+
+
+if __name__ == '__main__':
+  print(get_host_stats())
@@ -0,0 +1,107 @@
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+This module describes the contents of a directory on the host, which is
+used to download only the files that changed since the last download.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+#: The directory that contains the cached hashes of the files of a
+#: directory, so that only new and modified files need to be hashed again.
+HASH_CACHE_DIR = os.path.expanduser('~/.cache/docker-remote/manifests')
+
+
+def hash_file(filename, chunk_size=1024 * 1024):
+  hasher = hashlib.sha256()
+  buf = bytearray(chunk_size)
+  view = memoryview(buf)
+  with open(filename, 'rb') as fp:
+    for n in iter(lambda: fp.readinto(buf), 0):
+      hasher.update(view[:n])
+  return hasher.hexdigest()
+
+
+def _hash_cache_filename(path):
+  digest = hashlib.sha1(path.encode('utf8')).hexdigest()
+  return os.path.join(HASH_CACHE_DIR, digest + '.json')
+
+
+def get_manifest(path):
+  """
+  Returns a dictionary that maps the paths of all regular files in the
+  directory *path* (relative to *path*, with forward slashes) to a list
+  of their size, modification time (in seconds) and SHA256 hash.
+  """
+
+  path = os.path.abspath(path)
+  cache_filename = _hash_cache_filename(path)
+  try:
+    with open(cache_filename) as fp:
+      cache = json.load(fp)
+  except (OSError, ValueError):
+    cache = {}
+
+  manifest = {}
+  for root, dirs, files in os.walk(path):
+    for name in files:
+      filename = os.path.join(root, name)
+      if os.path.islink(filename) or not os.path.isfile(filename):
+        continue
+      st = os.stat(filename)
+      relpath = os.path.relpath(filename, path).replace(os.sep, '/')
+      size, mtime = st.st_size, int(st.st_mtime)
+      entry = cache.get(relpath)
+      if entry is None or entry[:2] != [size, mtime]:
+        entry = [size, mtime, hash_file(filename)]
+      manifest[relpath] = entry
+
+  if manifest != cache:
+    os.makedirs(HASH_CACHE_DIR, exist_ok=True)
+    tmpfile = '{}.{}'.format(cache_filename, os.getpid())
+    with open(tmpfile, 'w') as fp:
+      json.dump(manifest, fp)
+    os.replace(tmpfile, cache_filename)
+  return manifest
+
+
+def has_command(name):
+  """
+  Returns #True if the program *name* is in the `PATH` of the host.
+  """
+
+  return shutil.which(name) is not None
+
+
+def remove_files(path, files):
+  """
+  Removes the *files* (paths relative to the directory *path*) that exist.
+  Paths outside of *path* are ignored.
+  """
+
+  path = os.path.abspath(path)
+  for relpath in files:
+    filename = os.path.abspath(os.path.join(path, relpath))
+    if filename.startswith(path + os.sep) and os.path.isfile(filename):
+      os.remove(filename)